@@ -24,7 +24,7 @@ import sys
 
 from vsc.accountpage.client import AccountpageClient
 from vsc.accountpage.wrappers import mkVo
-from vsc.administration.slurm.sacctmgr import get_slurm_sacct_info, SacctMgrTypes
+from vsc.administration.slurm.sacctmgr import get_slurm_sacct_info_many, SacctMgrTypes
 from vsc.administration.slurm.sync import (
     execute_commands, slurm_institute_accounts, slurm_vo_accounts, slurm_user_accounts,
     )
@@ -95,8 +95,10 @@ def main():
         client = AccountpageClient(token=opts.options.access_token, url=opts.options.account_page_url + "/api/")
         host_institute = opts.options.host_institute
 
-        slurm_account_info = get_slurm_sacct_info(SacctMgrTypes.accounts)
-        slurm_user_info = get_slurm_sacct_info(SacctMgrTypes.users)
+        # the listings are independent, so the sacctmgr commands run concurrently
+        infos = get_slurm_sacct_info_many([SacctMgrTypes.accounts, SacctMgrTypes.users])
+        slurm_account_info = infos[SacctMgrTypes.accounts]
+        slurm_user_info = infos[SacctMgrTypes.users]
 
         logging.debug("%d accounts found", len(slurm_account_info))
         logging.debug("%d users found", len(slurm_user_info))
@@ -55,7 +55,7 @@ from vsc.administration.slurm.sacctmgr import (
     create_modify_resource_license_command,
 )
 from vsc.administration.slurm.scontrol import (
-    get_scontrol_info, ScontrolTypes,
+    get_scontrol_info_many, ScontrolTypes,
     get_scontrol_config, LICENSE_RESERVATION_PREFIX,
     make_license_reservation_name, create_create_license_reservation,
     create_update_license_reservation, create_delete_reservation,
@@ -262,7 +262,9 @@ def update_license_reservations(licenses, cluster, partition, ignore_reservation
         logging.error("Expected cluster %s, got %s (%s)", cluster, slurm_config.ClusterName, slurm_config)
         raise Exception("Wrong cluster")
 
-    partitions = get_scontrol_info(ScontrolTypes.partition)
+    infos = get_scontrol_info_many([ScontrolTypes.partition, ScontrolTypes.license, ScontrolTypes.reservation])
+
+    partitions = infos[ScontrolTypes.partition]
     if partition not in partitions:
         logging.error("Expected partiton %s, only have %s", partition, partitions)
         raise Exception("Wrong partition")
@@ -271,14 +273,14 @@ def update_license_reservations(licenses, cluster, partition, ignore_reservation
     # Get the licenses
     #    This cluster should see all licenses, incl their usage
     # Convert to dict with reservation names
-    lics = dict([(make_license_reservation_name(k), v) for k, v in get_scontrol_info(ScontrolTypes.license).items()])
+    lics = dict([(make_license_reservation_name(k), v) for k, v in infos[ScontrolTypes.license].items()])
     logging.debug("Existing licenses %s", lics)
 
     # Get all existing license reservations
     #    only license reservations
     #       remove the ignore_reservations also
     # The LICENSE_ONLY flag does not show up in flags
-    ress = dict([(k, v) for k, v in get_scontrol_info(ScontrolTypes.reservation).items()
+    ress = dict([(k, v) for k, v in infos[ScontrolTypes.reservation].items()
                  if v.Licenses is not None
                  and v.ReservationName.startswith(LICENSE_RESERVATION_PREFIX)
                  and k not in ignore_reservations
@@ -32,7 +32,7 @@ import logging
 import sys
 
 from vsc.accountpage.client import AccountpageClient
-from vsc.accountpage.wrappers import mkVscUserSizeQuota
+from vsc.accountpage.wrappers import mkVscAccount, mkVscUserSizeQuota
 from vsc.administration.user import process_users, process_users_quota
 from vsc.administration.vo import process_vos
 from vsc.config.base import GENT
@@ -103,6 +103,14 @@ def main():
                         len(changed_accounts), institute, last_timestamp)
 
             accounts = nub([u['vsc_id'] for u in changed_accounts])
+            # the changed accounts are complete account records, the users need not fetch them one by one
+            # users with a record that cannot be used fetch their account themselves, as before
+            account_info = {}
+            for u in changed_accounts:
+                try:
+                    account_info[u['vsc_id']] = mkVscAccount(u)
+                except Exception as err:
+                    logging.warning("Cannot use the changed account record %s, fetching it per user: %s", u, err)
 
             for storage_name in opts.options.storage:
                 (users_ok, users_fail) = process_users(
@@ -110,7 +118,8 @@ def main():
                     accounts,
                     storage_name,
                     client,
-                    institute)
+                    institute,
+                    accounts=account_info)
                 stats["%s_users_sync" % (storage_name,)] = len(users_ok)
                 stats["%s_users_sync_fail" % (storage_name,)] = len(users_fail)
                 stats["%s_users_sync_fail_warning" % (storage_name,)] = STORAGE_USERS_LIMIT_WARNING
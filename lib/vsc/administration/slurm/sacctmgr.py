@@ -16,9 +16,11 @@
 sacctmgr commands
 """
 import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+from operator import itemgetter
 
-from vsc.accountpage.wrappers import mkNamedTupleInstance
 from vsc.config.base import ANTWERPEN, BRUSSEL, GENT, LEUVEN
 from vsc.utils.missing import namedtuple_with_defaults
 from vsc.utils.run import asyncloop
@@ -33,6 +35,7 @@ SLURM_ORGANISATIONS = {
     GENT: 'ugent',
     LEUVEN: 'kuleuven',
 }
+SLURM_ORGANISATION_ARGS = dict((k, f"Organization={v}") for (k, v) in SLURM_ORGANISATIONS.items())
 
 
 class SacctMgrException(Exception):
@@ -74,9 +77,21 @@ SacctResourceFields = [
     "Name", "Server", "Type", "Count", "PCT__Allocated", "ServerType",
 ]
 
-IGNORE_USERS = ["root"]
-IGNORE_ACCOUNTS = ["root"]
-IGNORE_QOS = ["normal"]
+IGNORE_USERS = frozenset(["root"])
+IGNORE_ACCOUNTS = frozenset(["root"])
+IGNORE_QOS = frozenset(["normal"])
+
+QOS_FLAGS = ["NoDecay", "DenyOnLimit"]
+
+# maximal number of names in a single sacctmgr command that acts on a comma separated list of names, e.g., users
+# or QOS of the form <cluster>-<project>
+# sacctmgr reads its commands from stdin through a fixed 4096 byte buffer (when built without readline)
+SACCT_MAX_NAMES = 50
+
+# columns with few distinct values, these are interned so all rows share the same string objects
+SACCT_INTERNED_FIELDS = [
+    "Cluster", "Org", "Partition", "Admin", "ServerType", "Account", "ParentName", "Def_Acct", "QOS", "Def_QOS",
+]
 
 SlurmAccount = namedtuple_with_defaults('SlurmAccount', SacctAccountFields)
 SlurmUser = namedtuple_with_defaults('SlurmUser', SacctUserFields)
@@ -85,95 +100,136 @@ SlurmResource = namedtuple_with_defaults('SlurmResource', SacctResourceFields)
 
 
 def mkSlurmAccount(fields):
-    """Make a named tuple from the given fields."""
-    account = mkNamedTupleInstance(fields, SlurmAccount)
-    if account.Account in IGNORE_ACCOUNTS:
-        return None
-    return account
+    """Make a named tuple from the given fields, ordered as SacctAccountFields."""
+    return SlurmAccount._make(fields)
 
 
 def mkSlurmUser(fields):
-    """Make a named tuple from the given fields."""
-    user = mkNamedTupleInstance(fields, SlurmUser)
-    if user.User in IGNORE_USERS:
-        return None
-    return user
+    """Make a named tuple from the given fields, ordered as SacctUserFields."""
+    return SlurmUser._make(fields)
 
 
 def mkSlurmQos(fields):
-    """Make a named tuple from the given fields"""
-    qos = mkNamedTupleInstance(fields, SlurmQos)
-    return qos
+    """Make a named tuple from the given fields, ordered as SacctQosFields."""
+    return SlurmQos._make(fields)
 
 
 def mkSlurmResource(fields):
-    """Make a named tuple from the given fields"""
-    fields['Count'] = int(fields['Count'])
-    resource = mkNamedTupleInstance(fields, SlurmResource)
-    return resource
+    """Make a named tuple from the given fields, ordered as SacctResourceFields."""
+    resource = SlurmResource._make(fields)
+    return resource._replace(Count=int(resource.Count))
+
+
+# creator and named tuple type for each kind of sacctmgr listing
+SACCT_CREATORS = {
+    SacctMgrTypes.accounts: (mkSlurmAccount, SlurmAccount),
+    SacctMgrTypes.users: (mkSlurmUser, SlurmUser),
+    SacctMgrTypes.qos: (mkSlurmQos, SlurmQos),
+    SacctMgrTypes.resource: (mkSlurmResource, SlurmResource),
+}
 
 
 def mksacctmgr(mode):
     """Decorator to prefix common sacctmgr code for mode"""
     def decorator(function):
         def wrapper(*args, **kwargs):
-            prefix = [SLURM_SACCT_MGR, "-i", mode]
-            return prefix + function(*args, **kwargs)
+            return [SLURM_SACCT_MGR, "-i", mode, *function(*args, **kwargs)]
         return wrapper
     return decorator
 
 
-def parse_slurm_sacct_line(header, line, info_type, user_field_number, account_field_number, exclude=None):
-    """Parse the line into the correct data type."""
-    fields = line.split("|")
+def parse_slurm_sacct_line(fields, creator, getter, ignore_field_number=None, ignore=None,
+                           user_field_number=None, interned=None, pad=False):
+    """Parse the fields of a line into the correct data type.
 
-    if info_type == SacctMgrTypes.accounts:
-        if exclude and fields[account_field_number] in exclude:
-            return None
-        if fields[user_field_number]:
-            # association information for a user. Users are processed later.
-            return None
-        creator = mkSlurmAccount
-    elif info_type == SacctMgrTypes.users:
-        creator = mkSlurmUser
-    elif info_type == SacctMgrTypes.qos:
-        creator = mkSlurmQos
-    elif info_type == SacctMgrTypes.resource:
-        creator = mkSlurmResource
-    else:
+    @param fields: the columns of the line
+    @param creator: function making the named tuple from the fields in the order of its definition
+    @param getter: itemgetter returning the columns of the named tuple fields, in the order of its definition
+    @param ignore_field_number: index of the name column that is checked against ignore
+    @param ignore: names for which the line is skipped
+    @param user_field_number: index of the user column, only set for account listings
+    @param interned: indices of the columns whose values should be interned
+    @param pad: the getter expects a None column after the last column, for the fields that are not in the output
+    """
+    if ignore and fields[ignore_field_number] in ignore:
+        return None
+
+    if user_field_number is not None and fields[user_field_number]:
+        # association information for a user. Users are processed later.
         return None
 
-    return creator(dict(zip(header, fields)))
+    if interned:
+        for i in interned:
+            fields[i] = sys.intern(fields[i])
+
+    if pad:
+        # pad a copy, the fields are still logged as they are if making the named tuple fails
+        return creator(getter(fields + [None]))
+
+    return creator(getter(fields))
 
 
 def parse_slurm_sacct_dump(lines, info_type, exclude=None):
-    """Parse the sacctmgr dump from the listing."""
-    acct_info = set()
+    """Parse the sacctmgr dump from the listing.
+
+    @returns: list of named tuples, one per (non-skipped) line
+    """
+    acct_info = []
+
+    try:
+        (creator, tupletype) = SACCT_CREATORS[info_type]
+    except KeyError:
+        return []
 
-    header = [w.replace(' ', '_').replace('%', 'PCT_') for w in lines[0].rstrip().split("|")]
+    header = lines[0].rstrip().replace(' ', '_').replace('%', 'PCT_').split("|")
     header_names = [h.lower() for h in header]
 
+    # map each named tuple field onto its column in the output, so lines are converted without an intermediate dict
+    # fields that are not in the output get the None column padded after the last column
+    positions = [header.index(f) if f in header else len(header) for f in tupletype._fields]
+    pad = len(header) in positions
+    getter = itemgetter(*positions)
+    interned = [header.index(f) for f in SACCT_INTERNED_FIELDS if f in header]
+
+    # ignored names are skipped before a named tuple is made for them
+    user_field_number = None
     if info_type == SacctMgrTypes.accounts:
         user_field_number = header_names.index("user")
-        account_field_number = header_names.index("account")
+        ignore_field_number = header_names.index("account")
+        ignore = IGNORE_ACCOUNTS.union(exclude) if exclude else IGNORE_ACCOUNTS
+    elif info_type == SacctMgrTypes.users:
+        ignore_field_number = header_names.index("user")
+        ignore = IGNORE_USERS
     else:
-        user_field_number = None
-        account_field_number = None
-
-    for line in lines[1:]:
-        logging.debug("line %s", line)
-        line = line.rstrip()
-        try:
+        ignore_field_number = None
+        ignore = None
+
+    # checked once, the log call per line is not free even when it emits nothing
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+    # the -P output is delimited by | and sacctmgr fields never contain a | themselves
+    # the lines come from splitlines, so there is no line ending left to strip
+    field_count = len(header)
+    fields = None
+    try:
+        for fields in (line.split("|") for line in lines[1:] if line):
+            if debug:
+                logging.debug("fields %s", fields)
+            if len(fields) != field_count:
+                logging.warning("Slurm sacct parse dump: skipping line %s with %d instead of %d fields",
+                                "|".join(fields), len(fields), field_count)
+                continue
             info = parse_slurm_sacct_line(
-                header, line, info_type, user_field_number, account_field_number, exclude=exclude
+                fields, creator, getter, ignore_field_number, ignore,
+                user_field_number=user_field_number, interned=interned, pad=pad,
             )
-        except Exception as err:
-            logging.exception("Slurm sacct parse dump: could not process line %s [%s]", line, err)
-            raise
-        # This fails when we get e.g., the users and look at the account lines.
-        # We should them just skip that line instead of raising an exception
-        if info:
-            acct_info.add(info)
+            # This fails when we get e.g., the users and look at the account lines.
+            # We should them just skip that line instead of raising an exception
+            if info:
+                acct_info.append(info)
+    except Exception as err:
+        logging.exception("Slurm sacct parse dump: could not process line %s [%s]", "|".join(fields or []), err)
+        raise
 
     return acct_info
 
@@ -182,7 +238,11 @@ def get_slurm_sacct_info(info_type, exclude=None):
     """Get slurm info for the given clusterself.
 
     @param info_type: SacctMgrTypes
+    @param exclude: names of the accounts that should be skipped
     """
+    if exclude:
+        exclude = frozenset(exclude)
+
     (exitcode, contents) = asyncloop([
         SLURM_SACCT_MGR,
         "-s",
@@ -198,6 +258,19 @@ def get_slurm_sacct_info(info_type, exclude=None):
     return info
 
 
+def get_slurm_sacct_info_many(info_types, exclude=None):
+    """Get slurm info for several types, running the sacctmgr commands concurrently.
+
+    @param info_types: list of SacctMgrTypes
+    @param exclude: names of the accounts that should be skipped
+    @returns: dict with the info (as returned by get_slurm_sacct_info) for each of the types
+    """
+    with ThreadPoolExecutor(max_workers=len(info_types)) as executor:
+        infos = list(executor.map(lambda info_type: get_slurm_sacct_info(info_type, exclude=exclude), info_types))
+
+    return dict(zip(info_types, infos))
+
+
 @mksacctmgr('add')
 def create_add_account_command(account, parent, organisation, cluster, fairshare=None, qos=None):
     """
@@ -213,15 +286,15 @@ def create_add_account_command(account, parent, organisation, cluster, fairshare
     command = [
         "account",
         account,
-        "Parent={0}".format(parent or "root"),
-        "Organization={0}".format(SLURM_ORGANISATIONS[organisation]),
-        "Cluster={0}".format(cluster)
+        f"Parent={parent or 'root'}",
+        SLURM_ORGANISATION_ARGS[organisation],
+        f"Cluster={cluster}"
     ]
 
     if fairshare is not None:
-        command.append("Fairshare={0}".format(fairshare))
+        command.append(f"Fairshare={fairshare}")
     if qos is not None:
-        command.append("Qos={0}".format(qos))
+        command.append(f"Qos={qos}")
 
     logging.debug(
         "Adding command to add account %s with Parent=%s Cluster=%s Organization=%s",
@@ -244,16 +317,11 @@ def create_default_account_command(user, account, cluster):
     """
     command = [
         "user",
-        "Name={0}".format(user),
-        "Cluster={0}".format(cluster),
+        f"Name={user}",
+        f"Cluster={cluster}",
         "set",
-        "DefaultAccount={0}".format(account),
+        f"DefaultAccount={account}",
     ]
-    logging.debug(
-        "Creating command to set default account to %s for %s on cluster %s",
-        account,
-        user,
-        cluster)
 
     return command
 
@@ -262,10 +330,10 @@ def create_default_account_command(user, account, cluster):
 def create_change_account_fairshare_command(account, cluster, fairshare):
     command = [
         "account",
-        "name={0}".format(account),
-        "cluster={0}".format(cluster),
+        f"name={account}",
+        f"cluster={cluster}",
         "set",
-        "fairshare={0}".format(fairshare),
+        f"fairshare={fairshare}",
     ]
     logging.debug(
         "Adding command to change fairshare for account %s on cluster %s to %d",
@@ -292,23 +360,79 @@ def create_add_user_command(user, account, cluster, default_account=None):
     command = [
         "user",
         user,
-        "Account={0}".format(account),
-        "Cluster={0}".format(cluster)
+        f"Account={account}",
+        f"Cluster={cluster}"
     ]
     if default_account is not None:
-        command.append(
-            "DefaultAccount={0}".format(account),
-        )
-    logging.debug(
-        "Adding command to add user %s with Account=%s Cluster=%s",
-        user,
-        account,
-        cluster,
-        )
+        command.append(f"DefaultAccount={account}")
 
     return command
 
 
+def merge_add_user_commands(commands, max_names=SACCT_MAX_NAMES):
+    """Merge add user commands with otherwise identical arguments into a single command.
+
+    sacctmgr accepts a comma separated list of user names, e.g., add user u1,u2 Account=a Cluster=c
+
+    Only commands within a run of consecutive add user commands are merged. The merged command takes the place
+    of the first command it contains, so users can end up being added before other add user commands of the
+    same run. Commands other than add user keep their position relative to all other commands.
+
+    @param commands: list of commands
+    @param max_names: maximal number of user names in a merged command, to keep the command line short
+    @returns: list of commands
+    """
+    prefix = [SLURM_SACCT_MGR, "-i", "add", "user"]
+    groups = []
+    current = {}  # arguments after the user name -> (command, user names) in the current run of add user commands
+    for command in commands:
+        if command[:4] == prefix:
+            args = tuple(command[5:])
+            if args in current and len(current[args][1]) < max_names:
+                current[args][1].append(command[4])
+                continue
+            current[args] = (command, [command[4]])
+            groups.append(current[args])
+        else:
+            current = {}
+            groups.append((command, None))
+
+    return [
+        command if users is None else command[:4] + [",".join(users)] + command[5:]
+        for (command, users) in groups
+    ]
+
+
+def sacctmgr_quote(arg):
+    """Quote an argument for a sacctmgr command line read from stdin.
+
+    sacctmgr only knows double quotes, which cannot be escaped. The value of a key=value argument is quoted
+    (as in Description="some text"), other arguments are quoted as a whole.
+
+    @raises SacctMgrException: if the argument cannot be quoted, i.e., it contains a double quote or a line break
+    """
+    if '"' in arg or "\n" in arg or "\r" in arg:
+        raise SacctMgrException(f"Cannot pass argument {arg!r} to sacctmgr")
+
+    if not arg or any(c.isspace() for c in arg):
+        (key, sep, value) = arg.partition("=")
+        if sep:
+            return f'{key}="{value}"'
+        return f'"{arg}"'
+
+    return arg
+
+
+def render_sacctmgr_script(commands):
+    """Render sacctmgr commands as a script that sacctmgr reads from stdin, one command per line.
+
+    @param commands: list of sacctmgr commands, as created by the mksacctmgr decorated functions
+    @returns: string with the commands, without the sacctmgr executable and its options
+    """
+    # command[2:] drops the SLURM_SACCT_MGR and -i prefix added by mksacctmgr
+    return "".join([" ".join([sacctmgr_quote(arg) for arg in command[2:]]) + "\n" for command in commands])
+
+
 def create_change_user_command(user, current_vo_id, new_vo_id, cluster):
     """Creates the commands to change a user's account.
 
@@ -347,14 +471,9 @@ def create_remove_user_command(user, cluster):
     """
     command = [
         "user",
-        "Name={user}".format(user=user),
-        "Cluster={cluster}".format(cluster=cluster)
+        f"Name={user}",
+        f"Cluster={cluster}"
     ]
-    logging.debug(
-        "Adding command to remove user %s from Cluster=%s",
-        user,
-        cluster,
-        )
 
     return command
 
@@ -367,8 +486,8 @@ def create_remove_account_command(account, cluster):
     """
     command = [
         "account",
-        "Name={account}".format(account=account),
-        "Cluster={cluster}".format(cluster=cluster),
+        f"Name={account}",
+        f"Cluster={cluster}",
     ]
 
     logging.debug(
@@ -388,18 +507,11 @@ def create_remove_user_account_command(user, account, cluster):
     """
     command = [
         "user",
-        "Name={user}".format(user=user),
-        "Account={account}".format(account=account),
-        "Cluster={cluster}".format(cluster=cluster)
+        f"Name={user}",
+        f"Account={account}",
+        f"Cluster={cluster}"
     ]
 
-    logging.debug(
-        "Adding command to remove user %s with account %s from Cluster=%s",
-        user,
-        account,
-        cluster,
-        )
-
     return command
 
 
@@ -411,7 +523,7 @@ def create_add_qos_command(name):
     """
     command = [
         "qos",
-        "Name={0}".format(name)
+        f"Name={name}"
     ]
 
     return command
@@ -428,17 +540,41 @@ def create_remove_qos_command(name):
     command = [
         "qos",
         "where",
-        "Name={0}".format(name),
+        f"Name={name}",
     ]
 
     return command
 
 
+def _sacct_value_items(value):
+    """Split a sacctmgr (list) value, e.g. a TRES specification, in its order-independent items."""
+    if value is None:
+        return set()
+    return set(str(value).split(","))
+
+
+def qos_has_settings(current, settings):
+    """Check if a QOS already has exactly the QOS_FLAGS and the given settings
+
+    The modify command replaces the flags of the QOS, so a QOS with other flags as well does not have the settings.
+
+    @param current: the SlurmQos as it is currently known in Slurm, if any
+    @param settings: dict with the items that should be set (key/value pairs)
+    """
+    if current is None:
+        return False
+
+    current_values = dict((f.lower(), getattr(current, f)) for f in current._fields)
+    return _sacct_value_items(current_values.get("flags")) == set(QOS_FLAGS) and all(
+        _sacct_value_items(current_values.get(k.lower())) == _sacct_value_items(v) for (k, v) in settings.items()
+    )
+
+
 @mksacctmgr('modify')
 def create_modify_qos_command(name, settings):
     """Create the command to modify a QOS
 
-    @param name: the name of the QOS to modify
+    @param name: the name of the QOS to modify, or a comma separated list of QOS names with the same settings
     @param settings: dict with the items that should be set (key/value pairs)
 
     @returns: the list comprising the command
@@ -447,11 +583,9 @@ def create_modify_qos_command(name, settings):
         "qos",
         name,
         "set",
-        "flags=NoDecay,DenyOnLimit",
+        f"flags={','.join(QOS_FLAGS)}",
     ]
-
-    for k, v in settings.items():
-        command.append("{0}={1}".format(k, v))
+    command.extend([f"{k}={v}" for (k, v) in settings.items()])
 
     return command
 
@@ -465,11 +599,11 @@ def create_add_resource_license_command(name, server, stype, clusters, count):
     command = [
         "resource",
         "Type=license",
-        "Name={0}".format(name),
-        "Server={0}".format(server),
-        "ServerType={0}".format(stype),
-        "Cluster={0}".format(",".join(clusters)),
-        "Count={0}".format(count),
+        f"Name={name}",
+        f"Server={server}",
+        f"ServerType={stype}",
+        f"Cluster={','.join(clusters)}",
+        f"Count={count}",
         "PercentAllowed=100",
     ]
 
@@ -486,9 +620,9 @@ def create_remove_resource_license_command(name, server, stype):
         "resource",
         "where",
         "Type=license",
-        "Name={0}".format(name),
-        "Server={0}".format(server),
-        "ServerType={0}".format(stype),
+        f"Name={name}",
+        f"Server={server}",
+        f"ServerType={stype}",
     ]
 
     return command
@@ -503,11 +637,11 @@ def create_modify_resource_license_command(name, server, stype, count):
     command = [
         "resource",
         "where",
-        "Name={0}".format(name),
-        "Server={0}".format(server),
-        "ServerType={0}".format(stype),
+        f"Name={name}",
+        f"Server={server}",
+        f"ServerType={stype}",
         "set",
-        "Count={0}".format(count),
+        f"Count={count}",
     ]
 
     return command
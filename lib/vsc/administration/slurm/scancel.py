@@ -25,15 +25,15 @@ def create_remove_user_jobs_command(user, cluster, state=None, account=None):
     """
     remove_user_jobs_command = [
         SLURM_SCANCEL,
-        "--cluster={cluster}".format(cluster=cluster),
-        "--user={user}".format(user=user),
+        f"--cluster={cluster}",
+        f"--user={user}",
     ]
 
     if state is not None:
-        remove_user_jobs_command.append("--state={state}".format(state=state))
+        remove_user_jobs_command.append(f"--state={state}")
 
     if account is not None:
-        remove_user_jobs_command.append("--account={account}".format(account=account))
+        remove_user_jobs_command.append(f"--account={account}")
 
     return remove_user_jobs_command
 
@@ -44,18 +44,11 @@ def create_remove_jobs_for_account_command(account, cluster):
 
     @returns: list comprising the account
     """
-    remove_jobs_command_pending = [
+    remove_jobs_command = [
         SLURM_SCANCEL,
-        "--cluster={cluster}".format(cluster=cluster),
-        "--account={account}".format(account=account),
-        "--state=PENDING",
+        f"--cluster={cluster}",
+        f"--account={account}",
+        "--state=PENDING,SUSPENDED",
     ]
-    remove_jobs_command_suspended = [
-        SLURM_SCANCEL,
-        "--cluster={cluster}".format(cluster=cluster),
-        "--account={account}".format(account=account),
-        "--state=SUSPENDED",
-    ]
-
-    return [remove_jobs_command_pending, remove_jobs_command_suspended]
 
+    return [remove_jobs_command]
@@ -17,18 +17,21 @@ scontrol commands
 """
 import logging
 import re
-import shlex
 
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
-from vsc.accountpage.wrappers import mkNamedTupleInstance
 from vsc.utils.missing import namedtuple_with_defaults
 from vsc.utils.run import asyncloop
 
 
 SLURM_SCONTROL = "/usr/bin/scontrol"
 
-SLURM_SCONTROL_CONFIG_REGEX = re.compile("^(.*\S)\s+=\s+(\S.*)$")
+SLURM_SCONTROL_CONFIG_REGEX = re.compile(r"^(.*\S)[ \t]+=[ \t]+(\S.*)$", re.M | re.ASCII)
+
+# KEY=VALUE tokens of the oneliner output, where VALUE is a double quoted string (group 2, without the quotes)
+# or a run of non-whitespace (group 3)
+SLURM_SCONTROL_TOKEN_REGEX = re.compile(r'(\S+?)=(?:"((?:[^"\\]|\\.)*)"|(\S*))', re.ASCII)
 
 
 LICENSE_RESERVATION_PREFIX = 'external_license_'
@@ -72,91 +75,108 @@ SlurmPartition = namedtuple_with_defaults('SlurmPartition', ScontrolPartitionFie
 
 def mkSlurmReservation(fields):
     """Make a named tuple from the given fields"""
-    reservation = mkNamedTupleInstance(fields, SlurmReservation)
+    reservation = SlurmReservation._make([fields.get(f) for f in ScontrolReservationFields])
     return reservation
 
 
 def mkSlurmLicense(fields):
     """Make a named tuple from the given fields"""
-    for key in ['Total', 'Used', 'Free', 'Reserved']:
-        fields[key] = int(fields[key])
-    lic = mkNamedTupleInstance(fields, SlurmLicense)
+    fields['Total'] = int(fields['Total'])
+    fields['Used'] = int(fields['Used'])
+    fields['Free'] = int(fields['Free'])
+    fields['Reserved'] = int(fields['Reserved'])
+    lic = SlurmLicense._make([fields.get(f) for f in ScontrolLicenseFields])
     return lic
 
 
 def mkSlurmConfig(fields):
     """Make a named tuple from the given fields"""
-    filtered = dict([(k, v) for k, v in fields.items() if k in ScontrolConfigFields])
-    config = mkNamedTupleInstance(filtered, SlurmConfig)
+    # the config has many more fields, only the few known ones are looked up
+    config = SlurmConfig._make([fields.get(f) for f in ScontrolConfigFields])
     return config
 
 
 def mkSlurmPartition(fields):
     """Make a named tuple from the given fields"""
-    for key in ['TotalCPUs', 'TotalNodes', 'DefMemPerCPU', 'MaxMemPerNode']:
-        fields[key] = int(fields[key])
-    lic = mkNamedTupleInstance(fields, SlurmPartition)
+    fields['TotalCPUs'] = int(fields['TotalCPUs'])
+    fields['TotalNodes'] = int(fields['TotalNodes'])
+    fields['DefMemPerCPU'] = int(fields['DefMemPerCPU'])
+    fields['MaxMemPerNode'] = int(fields['MaxMemPerNode'])
+    lic = SlurmPartition._make([fields.get(f) for f in ScontrolPartitionFields])
     return lic
 
 
+# creator for each kind of scontrol listing
+SCONTROL_CREATORS = {
+    ScontrolTypes.license: mkSlurmLicense,
+    ScontrolTypes.reservation: mkSlurmReservation,
+    ScontrolTypes.config: mkSlurmConfig,
+    ScontrolTypes.partition: mkSlurmPartition,
+}
+
+
 def mkscontrol(mode):
     """Decorator to prefix common sacctmgr code for mode"""
     def decorator(function):
         def wrapper(*args, **kwargs):
-            prefix = [SLURM_SCONTROL, mode]
-            return prefix + function(*args, **kwargs)
+            return [SLURM_SCONTROL, mode, *function(*args, **kwargs)]
         return wrapper
     return decorator
 
 
-def parse_scontrol_line(line, info_type):
-    """Parse the line into the correct data type."""
-    # output should have eg 'Flags=' or 'Account=(null)'
-    fields = dict([x.split("=", 1) for x in shlex.split(line)])
+def parse_scontrol_line(line, creator):
+    """Parse the line into the correct data type.
 
-    # convert all null to None
-    for key in fields.keys():
-        if fields[key] == '(null)':
-            fields[key] = None
+    @param creator: function making the named tuple from the fields dict
+    """
+    # output should have eg 'Flags=' or 'Account=(null)'
+    fields = {}
+    for (key, quoted, plain) in SLURM_SCONTROL_TOKEN_REGEX.findall(line):
+        value = quoted or plain
+        # convert all null to None
+        fields[key] = None if value == '(null)' else value
 
     # sanity check for keys vs the fields?
 
-    if info_type == ScontrolTypes.license:
-        creator = mkSlurmLicense
-    elif info_type == ScontrolTypes.reservation:
-        creator = mkSlurmReservation
-    elif info_type == ScontrolTypes.config:
-        creator = mkSlurmConfig
-    elif info_type == ScontrolTypes.partition:
-        creator = mkSlurmPartition
-    else:
-        return None
-
     return creator(fields)
 
 
 def parse_scontrol_dump(lines, info_type):
-    """Parse the scontrol dump from the listing."""
-    info = set()
+    """Parse the scontrol dump from the listing.
 
-    if len(lines) == 1 and lines[0].startswith('No '):
-        logging.warning("Output indicates there was no result for type %s: '%s'", info_type, lines[0])
+    @returns: list of named tuples, one per (non-empty) line
+    """
+    info = []
+
+    creator = SCONTROL_CREATORS.get(info_type)
+    if creator is None:
+        return []
+
+    # e.g. 'No reservations in the system', possibly surrounded by blank lines
+    first_line = next((line for line in lines if line and not line.isspace()), None)
+    if first_line is None:
+        return info
+    if first_line.startswith('No '):
+        logging.warning("Output indicates there was no result for type %s: '%s'", info_type, first_line)
     else:
-        for line in lines:
-            logging.debug("line %s", line)
-            line = line.rstrip()
+        # checked once, the log call per line is not free even when it emits nothing
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
 
-            if not line:
+        for line in lines:
+            if debug:
+                logging.debug("line %s", line)
+            # trailing whitespace does not matter to the tokenizer, so only blank lines are skipped
+            if not line or line.isspace():
                 continue
 
             try:
-                parsed = parse_scontrol_line(line, info_type)
+                parsed = parse_scontrol_line(line, creator)
             except Exception as err:
                 logging.exception("Slurm scontrol parse dump: could not process line %s [%s]", line, err)
                 raise
 
             if parsed:
-                info.add(parsed)
+                info.append(parsed)
 
     return info
 
@@ -165,6 +185,7 @@ def get_scontrol_info(info_type, as_dict=True):
     """Get slurm info for the given clusterself.
 
     @param info_type: ScontrolTypes
+    @returns: dict mapping the names on the named tuples if as_dict, otherwise the list of named tuples
     """
     (exitcode, contents) = asyncloop([
         SLURM_SCONTROL,
@@ -176,24 +197,35 @@ def get_scontrol_info(info_type, as_dict=True):
     if exitcode != 0:
         raise Exception("Cannot run scontrol")
 
-    lines = contents.splitlines()
     if info_type == ScontrolTypes.config:
-        # there is one config, so convert the multilines in single line
-        fields = []
-        for line in lines:
-            if SLURM_SCONTROL_CONFIG_REGEX.match(line):
-                fields.append(SLURM_SCONTROL_CONFIG_REGEX.sub(r'\1="\2"', line))
-        lines = [" ".join(fields)]
-
-    info = parse_scontrol_dump(lines, info_type)
+        # there is one config, its multiline 'key = value' output is parsed directly
+        fields = dict([
+            (key, None if value == '(null)' else value)
+            for (key, value) in SLURM_SCONTROL_CONFIG_REGEX.findall(contents)
+        ])
+        info = [mkSlurmConfig(fields)]
+    else:
+        info = parse_scontrol_dump(contents.splitlines(), info_type)
 
     if as_dict:
         field = "%sName" % info_type.value.capitalize()
-        info = dict([(getattr(x, field), x) for x in info])
+        info = {getattr(x, field): x for x in info}
 
     return info
 
 
+def get_scontrol_info_many(info_types, as_dict=True):
+    """Get slurm info for several types, running the scontrol commands concurrently.
+
+    @param info_types: list of ScontrolTypes
+    @returns: dict with the info (as returned by get_scontrol_info) for each of the types
+    """
+    with ThreadPoolExecutor(max_workers=len(info_types)) as executor:
+        infos = list(executor.map(lambda info_type: get_scontrol_info(info_type, as_dict=as_dict), info_types))
+
+    return dict(zip(info_types, infos))
+
+
 def get_scontrol_config():
     """Return the scontrol config namedtuple"""
     return get_scontrol_info(ScontrolTypes.config, as_dict=False).pop()
@@ -206,7 +238,7 @@ def make_license_reservation_name(licname):
 
 def _settings_args(settings):
     """Convert settings dict in k=v list"""
-    return ["{0}={1}".format(k, settings[k]) for k in sorted(settings.keys())]
+    return [f"{k}={v}" for (k, v) in sorted(settings.items())]
 
 
 @mkscontrol('create')
@@ -216,7 +248,7 @@ def create_create_reservation(reservation, settings):
     """
     command = [
         'reservation',
-        'ReservationName={0}'.format(reservation),
+        f'ReservationName={reservation}',
     ]
     command.extend(_settings_args(settings))
 
@@ -230,7 +262,7 @@ def create_update_reservation(reservation, settings):
     """
     command = [
         'reservation',
-        'ReservationName={0}'.format(reservation),
+        f'ReservationName={reservation}',
     ]
 
     command.extend(_settings_args(settings))
@@ -245,7 +277,7 @@ def create_delete_reservation(reservation):
     """
     command = [
         'reservation',
-        'ReservationName={0}'.format(reservation),
+        f'ReservationName={reservation}',
     ]
     return command
 
@@ -258,7 +290,7 @@ def create_create_license_reservation(licname, value, partition):
     # infinite/unlimited means 1 year
     days = 20 * 365
     settings = {
-        'Licenses': '{0}:{1}'.format(licname, value),
+        'Licenses': f'{licname}:{value}',
         'Partition': partition,
         'Start': 'now',
         'Duration': f'{days}-0:0:0',
@@ -276,6 +308,6 @@ def create_update_license_reservation(licname, value):
     """
     name = make_license_reservation_name(licname)
     settings = {
-        'Licenses': '{0}:{1}'.format(licname, value),
+        'Licenses': f'{licname}:{value}',
     }
     return create_update_reservation(name, settings)
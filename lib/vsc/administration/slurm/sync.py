@@ -18,16 +18,23 @@ Functions to deploy users to slurm.
 import logging
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import groupby
+from operator import attrgetter
 
 from vsc.config.base import GENT, INSTITUTE_VOS_BY_INSTITUTE, INSTITUTE_FAIRSHARE
 from vsc.utils.run import RunNoShell
 from vsc.administration.slurm.sacctmgr import (
+    SLURM_SACCT_MGR, SACCT_MAX_NAMES,
+    merge_add_user_commands, render_sacctmgr_script,
     create_add_account_command, create_remove_account_command,
     create_change_account_fairshare_command,
     create_add_user_command, create_change_user_command, create_remove_user_command, create_remove_user_account_command,
-    create_add_qos_command, create_remove_qos_command, create_modify_qos_command
+    create_add_qos_command, create_remove_qos_command, create_modify_qos_command, qos_has_settings,
     )
 from vsc.administration.slurm.scancel import (
+    SLURM_SCANCEL,
     create_remove_user_jobs_command, create_remove_jobs_for_account_command,
     )
 
@@ -40,20 +47,137 @@ class SCommandException(Exception):
     pass
 
 
-def execute_commands(commands):
-    """Run the specified commands"""
+SACCTMGR_PREFIX = [SLURM_SACCT_MGR, "-i"]
+
+# maximal number of commands passed to a single sacctmgr process, this bounds the size of its input and
+# the number of commands that are rerun one by one when it fails
+SACCTMGR_BATCH_SIZE = 256
+
+# sacctmgr output of an add, remove or modify command that found nothing to do, e.g., as it was already done
+SACCTMGR_ALREADY_APPLIED = (
+    "Nothing new added",
+    "Nothing deleted",
+    "Nothing modified",
+)
+
+# maximal number of scancel commands that run at the same time
+SCANCEL_FANOUT = 16
+
+
+def execute_command(command):
+    """Run the specified command"""
+    logging.info("Running command: %s", command)
+
+    # if one fails, we simply fail the script and should get notified
+    (ec, _) = RunNoShell.run(command)
+    if ec != 0:
+        raise SCommandException(f"Command failed: {command}")
+
+
+def execute_sacctmgr_command_again(command):
+    """Run the specified sacctmgr command again, after running it in a failed batch.
+
+    sacctmgr continues with the next command when a command read from stdin fails, so the command may already
+    have been applied in the batch. Running it again then fails with nothing to do, which is not an error.
+    """
+    logging.info("Running command again: %s", command)
+
+    (ec, output) = RunNoShell.run(command)
+    if ec != 0:
+        if any(message in output for message in SACCTMGR_ALREADY_APPLIED):
+            logging.info("Command was already applied: %s (%s)", command, output.strip())
+        else:
+            raise SCommandException(f"Command failed: {command} ({output.strip()})")
+
+
+def execute_sacctmgr_commands(commands, batch_size=SACCTMGR_BATCH_SIZE):
+    """Run the specified sacctmgr commands in batches, each batch in a single sacctmgr process.
+
+    Without a command on the command line, sacctmgr reads its commands line by line from stdin.
+    If a batch fails, its commands are run again one by one, to find the failing command. Commands that were
+    already applied by the batch are skipped, the first command that still fails raises an SCommandException.
+
+    @param commands: list of sacctmgr commands, as created by the mksacctmgr decorated functions
+    @param batch_size: maximal number of commands passed to a single sacctmgr process
+    """
+    commands = merge_add_user_commands(commands)
 
-    for command in commands:
-        logging.info("Running command: %s", command)
+    for start in range(0, len(commands), batch_size):
+        batch = commands[start:start + batch_size]
+        script = render_sacctmgr_script(batch)
+        logging.info("Running %d sacctmgr commands: %s", len(batch), script)
 
-        # if one fails, we simply fail the script and should get notified
-        (ec, _) = RunNoShell.run(command)
+        (ec, output) = RunNoShell.run(SACCTMGR_PREFIX, input=script)
         if ec != 0:
-            raise SCommandException("Command failed: {0}".format(command))
+            logging.warning("Running %d sacctmgr commands at once failed (%s), running them one by one",
+                            len(batch), output)
+            for command in batch:
+                execute_sacctmgr_command_again(command)
+
+
+def execute_scancel_commands(commands, fanout=SCANCEL_FANOUT):
+    """Run the specified scancel commands concurrently.
+
+    The commands are independent of each other, so they need not wait for one another. All commands are run,
+    even if some of them fail.
+
+    @param commands: list of scancel commands
+    @param fanout: maximal number of commands that run at the same time
+    """
+    logging.info("Running %d scancel commands: %s", len(commands), commands)
+
+    with ThreadPoolExecutor(max_workers=min(fanout, len(commands))) as executor:
+        results = list(executor.map(RunNoShell.run, commands))
+
+    failed = [command for (command, (ec, _)) in zip(commands, results) if ec != 0]
+    if failed:
+        raise SCommandException(f"Commands failed: {failed}")
+
+
+def _command_kind(command):
+    """Returns the executable of the command, if it is run in batches, or None"""
+    if command[:len(SACCTMGR_PREFIX)] == SACCTMGR_PREFIX:
+        return SLURM_SACCT_MGR
+    if command[0] == SLURM_SCANCEL:
+        return SLURM_SCANCEL
+    return None
+
+
+def execute_commands(commands):
+    """Run the specified commands
+
+    Consecutive sacctmgr commands are run in a single sacctmgr process and consecutive scancel commands
+    run concurrently. A batch only starts once the preceding commands have finished.
+    """
+    for (kind, batch) in groupby(commands, key=_command_kind):
+        batch = list(batch)
+        if kind == SLURM_SACCT_MGR:
+            execute_sacctmgr_commands(batch)
+        elif kind == SLURM_SCANCEL:
+            execute_scancel_commands(batch)
+        else:
+            for command in batch:
+                execute_command(command)
 
 
 TIER1_GPU_TO_CPU_HOURS_RATE = 12 # 12 cpus per gpu
 
+# shared result for lookups of accounts without users, it must never be modified
+_EMPTY_SET = frozenset()
+
+_cluster_account_share = attrgetter('Cluster', 'Account', 'Share')
+_user_account = attrgetter('User', 'Account')
+_user_default_account = attrgetter('User', 'Def_Acct')
+
+
+def _index_by_cluster(slurm_info, clusters):
+    """Group the entries of the Slurm info by their Cluster, for each of the given clusters"""
+    index = dict([(cluster, []) for cluster in clusters])
+    for info in slurm_info:
+        if info and info.Cluster in index:
+            index[info.Cluster].append(info)
+    return index
+
 
 def slurm_institute_accounts(slurm_account_info, clusters, host_institute, institute_vos):
     """Check for the presence of the institutes and their default VOs in the slurm account list.
@@ -61,9 +185,12 @@ def slurm_institute_accounts(slurm_account_info, clusters, host_institute, insti
     @returns: list of sacctmgr commands to add the accounts to the clusters if needed
     """
     commands = []
+    institute_vo_items = sorted(INSTITUTE_VOS_BY_INSTITUTE[host_institute].items())
+    institute_fairshare = INSTITUTE_FAIRSHARE[host_institute]
+    accounts_by_cluster = _index_by_cluster(slurm_account_info, clusters)
     for cluster in clusters:
-        cluster_accounts = [acct.Account for acct in slurm_account_info if acct and acct.Cluster == cluster]
-        for (inst, vo) in sorted(list(INSTITUTE_VOS_BY_INSTITUTE[host_institute].items())):
+        cluster_accounts = {acct.Account for acct in accounts_by_cluster[cluster]}
+        for (inst, vo) in institute_vo_items:
 
             if inst not in cluster_accounts:
                 commands.append(
@@ -72,7 +199,7 @@ def slurm_institute_accounts(slurm_account_info, clusters, host_institute, insti
                         parent=None,
                         cluster=cluster,
                         organisation=inst,
-                        fairshare=INSTITUTE_FAIRSHARE[host_institute][inst]
+                        fairshare=institute_fairshare[inst]
                     )
                 )
             if vo not in cluster_accounts:
@@ -89,12 +216,24 @@ def slurm_institute_accounts(slurm_account_info, clusters, host_institute, insti
     return commands
 
 
+def get_accounts_by_cluster(slurm_account_info, clusters):
+    """Returns a dict mapping each of the given clusters on a dict with its accounts and their share
+
+    The account info is traversed only once, instead of once per cluster.
+    """
+    accounts = dict([(cluster, {}) for cluster in clusters])
+    for (cluster, account, share) in map(_cluster_account_share, filter(None, slurm_account_info)):
+        if cluster in accounts:
+            accounts[cluster][account] = int(share)
+    return accounts
+
+
 def get_cluster_accounts(slurm_account_info, cluster):
-    return dict([
-            (acct.Account, int(acct.Share))
-            for acct in slurm_account_info
-            if acct and acct.Cluster == cluster
-        ])
+    """Returns a dict with the accounts and their share for the given cluster
+
+    Use get_accounts_by_cluster when the accounts of several clusters are needed.
+    """
+    return get_accounts_by_cluster(slurm_account_info, [cluster])[cluster]
 
 
 def get_cluster_qos(slurm_qos_info, cluster):
@@ -103,28 +242,61 @@ def get_cluster_qos(slurm_qos_info, cluster):
     return [qi.Name for qi in slurm_qos_info if qi.Name.startswith(cluster)]
 
 
+def get_qos_by_cluster(slurm_qos_info, clusters):
+    """Returns a dict with the list of QOS names related to each of the given clusters
+
+    Project QOS are named <cluster>-<project>, so the QOS are bucketed on the part before the first '-'
+    in a single pass, instead of matching all QOS against each cluster.
+    Clusters with a '-' in their name cannot be found that way, their QOS are matched on the prefix.
+    """
+    qos = dict([(cluster, []) for cluster in clusters])
+    dashed_prefixes = [(cluster, cluster + '-') for cluster in clusters if '-' in cluster]
+    for qi in slurm_qos_info:
+        cluster = qi.Name.partition('-')[0]
+        if cluster in qos:
+            qos[cluster].append(qi.Name)
+        for (cluster, prefix) in dashed_prefixes:
+            if qi.Name.startswith(prefix):
+                qos[cluster].append(qi.Name)
+    return qos
+
+
 def slurm_project_qos(projects, slurm_qos_info, clusters, protected_qos, qos_cleanup=False):
     """Check for new/changed projects and set their QOS accordingly"""
     commands = []
+    current_qos = dict([(qi.Name, qi) for qi in slurm_qos_info])
+    qos_by_cluster = get_qos_by_cluster(slurm_qos_info, clusters)
     for cluster in clusters:
-        cluster_qos_names = set(get_cluster_qos(slurm_qos_info, cluster)) - set(protected_qos)
-        project_qos_names = set([
-            "{cluster}-{project_name}".format(cluster=cluster, project_name=p.name) for p in projects
-        ])
+        cluster_qos_names = set(qos_by_cluster[cluster]) - set(protected_qos)
+        project_qos_names = set()
+
+        # names of the QOS that need to be modified, grouped by their GRPTRESMins
+        modify_qos_names = defaultdict(list)
 
         for project in projects:
-            qos_name = "{0}-{1}".format(cluster, project.name)
+            qos_name = f"{cluster}-{project.name}"
+            project_qos_names.add(qos_name)
             if qos_name not in cluster_qos_names:
                 commands.append(create_add_qos_command(qos_name))
-            commands.append(create_modify_qos_command(qos_name, {
-                "GRPTRESMins": "billing={cpuminutes},cpu={cpuminutes},gres/gpu={gpuminutes}".format(
-                    cpuminutes=60*int(project.cpu_hours)
-                        + TIER1_GPU_TO_CPU_HOURS_RATE * 60 * int(project.gpu_hours),
-                    gpuminutes=max(1, 60*int(project.gpu_hours)))
-                }))
+            cpu_hours = int(project.cpu_hours)
+            gpu_hours = int(project.gpu_hours)
+            cpuminutes = 60 * cpu_hours + TIER1_GPU_TO_CPU_HOURS_RATE * 60 * gpu_hours
+            gpuminutes = max(1, 60 * gpu_hours)
+            grptresmins = f"billing={cpuminutes},cpu={cpuminutes},gres/gpu={gpuminutes}"
+            # nothing to do if the QOS already has these settings
+            if not qos_has_settings(current_qos.get(qos_name), {"GRPTRESMins": grptresmins}):
+                modify_qos_names[grptresmins].append(qos_name)
 
             # TODO: if we pass a cutoff date, we need to alter the hours if less was spent
 
+        # sacctmgr modifies all QOS in a comma separated list, so QOS with the same settings share a command
+        # with a limited number of QOS per command, to keep the command line short
+        for (grptresmins, qos_names) in modify_qos_names.items():
+            for start in range(0, len(qos_names), SACCT_MAX_NAMES):
+                commands.append(create_modify_qos_command(
+                    ",".join(qos_names[start:start + SACCT_MAX_NAMES]), {"GRPTRESMins": grptresmins}
+                ))
+
         # We should actually keep the QOS, so we keep the usage on the slurm system
         # in case a project returns from the dead by receiving an extension past the
         # former end date
@@ -147,20 +319,20 @@ def slurm_project_accounts(resource_app_projects, slurm_account_info, clusters,
     The account gets access to each QOS in the general_qos list
     """
     commands = []
+    accounts_by_cluster = get_accounts_by_cluster(slurm_account_info, clusters)
+    resource_app_project_names = {p.name for p in resource_app_projects}
     for cluster in clusters:
-        cluster_accounts = set(get_cluster_accounts(slurm_account_info, cluster).keys())
-
-        resource_app_project_names = set([p.name for p in resource_app_projects])
+        # the keys view supports the set operations below without copying the accounts into a set
+        cluster_accounts = accounts_by_cluster[cluster].keys()
 
         for project_name in resource_app_project_names - cluster_accounts:
-            if project_name not in cluster_accounts:
-                commands.append(create_add_account_command(
-                    account=project_name,
-                    parent="projects",  # in case we want to deploy on Tier-2 as well
-                    cluster=cluster,
-                    organisation=GENT,   # tier-1 projects run here :p
-                    qos=",".join(["{0}-{1}".format(cluster, project_name)] + general_qos),
-                ))
+            commands.append(create_add_account_command(
+                account=project_name,
+                parent="projects",  # in case we want to deploy on Tier-2 as well
+                cluster=cluster,
+                organisation=GENT,   # tier-1 projects run here :p
+                qos=",".join([f"{cluster}-{project_name}"] + general_qos),
+            ))
 
         for project_name in cluster_accounts - resource_app_project_names:
             if project_name not in protected_accounts:
@@ -180,13 +352,15 @@ def slurm_vo_accounts(account_page_vos, slurm_account_info, clusters, host_insti
     @returns: list of sacctmgr commands to add the accounts for VOs if needed
     """
     commands = []
+    default_vo_ids = frozenset(INSTITUTE_VOS_BY_INSTITUTE[host_institute].values())
+    accounts_by_cluster = get_accounts_by_cluster(slurm_account_info, clusters)
     for cluster in clusters:
-        cluster_accounts = get_cluster_accounts(slurm_account_info, cluster)
+        cluster_accounts = accounts_by_cluster[cluster]
 
         for vo in account_page_vos:
 
             # skip the "default" VOs for our own institute
-            if vo.vsc_id in INSTITUTE_VOS_BY_INSTITUTE[host_institute].values():
+            if vo.vsc_id in default_vo_ids:
                 continue
 
             # create a new account for a VO that does not already have an account
@@ -233,13 +407,22 @@ def slurm_project_users_accounts(
     """
 
     commands = []
+    users_by_cluster = _index_by_cluster(slurm_user_info, clusters)
+    protected_accounts = frozenset(protected_accounts)
 
     for cluster in clusters:
-        cluster_users_acct = [
-            (user.User, user.Account) for user in slurm_user_info if user and user.Cluster == cluster
-        ]
+        if not project_members and not users_by_cluster[cluster]:
+            # there is nothing to add or remove on this cluster
+            continue
+
+        cluster_users_acct = list(map(_user_account, users_by_cluster[cluster]))
+
+        # the current Slurm users for each account
+        cluster_users_by_acct = defaultdict(set)
+        for (user, acct) in cluster_users_acct:
+            cluster_users_by_acct[acct].add(user)
 
-        protected_users = [u for (u, a) in cluster_users_acct if a in protected_accounts]
+        protected_users = {u for (u, a) in cluster_users_acct if a in protected_accounts}
 
         new_users = set()
         remove_project_users = set()
@@ -248,20 +431,20 @@ def slurm_project_users_accounts(
         for (members, project_name) in project_members:
 
             # these are the current Slurm users for this project
-            slurm_project_users = set([user for (user, acct) in cluster_users_acct if acct == project_name])
+            slurm_project_users = cluster_users_by_acct.get(project_name, _EMPTY_SET)
             all_project_users |= slurm_project_users
 
             # these users are not yet in the Slurm DBD for this project
-            new_users |= set([(user, project_name) for user in (members & active_accounts) - slurm_project_users])
+            new_users |= {(user, project_name) for user in (members & active_accounts) - slurm_project_users}
 
             # these are the Slurm users that should no longer be associated with the project
-            remove_project_users |= set([(user, project_name) for user in slurm_project_users - members])
+            remove_project_users |= {(user, project_name) for user in slurm_project_users - members}
 
         logging.info("%d new users", len(new_users))
         logging.info("%d removed project users", len(remove_project_users))
 
         # these are the users not in any project, we should decide if we want any of those
-        remove_slurm_users = set([u[0] for u in cluster_users_acct if u not in protected_users]) - all_project_users
+        remove_slurm_users = {u for (u, _) in cluster_users_acct} - protected_users - all_project_users
 
         if remove_slurm_users:
             logging.warning(
@@ -269,30 +452,31 @@ def slurm_project_users_accounts(
             )
 
         # create associations in the default account for users that do not already have one
-        cluster_users_with_default_account = set([u for (u, a) in cluster_users_acct if a == default_account])
-        commands.extend([create_add_user_command(
-            user=user,
-            account=default_account,
-            default_account=default_account,
-            cluster=cluster) for (user, _) in new_users if user not in cluster_users_with_default_account
+        cluster_users_with_default_account = cluster_users_by_acct.get(default_account, _EMPTY_SET)
+        add_default_account_user = partial(
+            create_add_user_command, account=default_account, default_account=default_account, cluster=cluster
+        )
+        commands.extend([
+            add_default_account_user(user=user)
+            for (user, _) in new_users if user not in cluster_users_with_default_account
         ])
 
         # create associations for the actual project's new users
-        commands.extend([create_add_user_command(
-            user=user,
-            account=project_name,
-            cluster=cluster) for (user, project_name) in new_users
+        add_cluster_user = partial(create_add_user_command, cluster=cluster)
+        commands.extend([
+            add_cluster_user(user=user, account=project_name) for (user, project_name) in new_users
         ])
 
         # kick out users no longer in the project
+        remove_cluster_user_account = partial(create_remove_user_account_command, cluster=cluster)
         commands.extend([
-            create_remove_user_account_command(user=user, account=project_name, cluster=cluster)
+            remove_cluster_user_account(user=user, account=project_name)
             for (user, project_name) in remove_project_users
         ])
 
         # remove associations in the default account for users no longer in any project
         commands.extend([
-            create_remove_user_account_command(user=user, account=default_account, cluster=cluster)
+            remove_cluster_user_account(user=user, account=default_account)
             for user in cluster_users_with_default_account - all_project_users if user not in protected_users
         ])
 
@@ -308,54 +492,57 @@ def slurm_user_accounts(vo_members, active_accounts, slurm_user_info, clusters,
     job_cancel_commands = defaultdict(list)
     association_remove_commands = []
 
-    active_vo_members = set()
+    # the active members of each VO do not depend on the cluster
+    active_vo_members_by_vo = dict([(vo_id, members & active_accounts) for (vo_id, (members, _)) in vo_members.items()])
+    active_vo_members = set().union(*active_vo_members_by_vo.values())
+
     reverse_vo_mapping = dict()
     for (members, vo) in vo_members.values():
-        # basic set arithmetic: take the intersection of the RHS sets and make the union with the LHS set
-        active_vo_members |= members & active_accounts
+        # the same tuple is shared by all members of the VO
+        reverse_vo_mapping.update(dict.fromkeys(members, (vo.vsc_id, vo.institute['name'])))
 
-        for m in members:
-            reverse_vo_mapping[m] = (vo.vsc_id, vo.institute['name'])
+    users_by_cluster = _index_by_cluster(slurm_user_info, clusters)
 
     for cluster in clusters:
-        cluster_users_acct = [
-            (user.User, user.Def_Acct) for user in slurm_user_info if user and user.Cluster == cluster
-        ]
-        cluster_users = set([u[0] for u in cluster_users_acct])
+        cluster_users_acct = tuple(map(_user_default_account, users_by_cluster[cluster]))
+        cluster_users = {u[0] for u in cluster_users_acct}
+
+        # the current Slurm users for each account, so the VO loop does not scan all users for every VO
+        cluster_users_by_acct = defaultdict(set)
+        for (user, acct) in cluster_users_acct:
+            cluster_users_by_acct[acct].add(user)
 
         # these are the users that need to be removed as they are no longer an active user in any
         # (including the institute default) VO
         remove_users = cluster_users - active_vo_members
 
         new_users = set()
-        changed_users = set()
         moved_users = set()
 
         for (vo_id, (members, vo)) in vo_members.items():
 
             # these are users not yet in the Slurm DB for this cluster
-            new_users |= set([
+            new_users |= {
                 (user, vo.vsc_id, vo.institute['name'])
-                for user in (members & active_accounts) - cluster_users
-            ])
+                for user in active_vo_members_by_vo[vo_id] - cluster_users
+            }
 
             # these are the current Slurm users per Account, i.e., the VO currently being processed
-            slurm_acct_users = set([user for (user, acct) in cluster_users_acct if acct == vo_id])
+            slurm_acct_users = cluster_users_by_acct.get(vo_id, _EMPTY_SET)
 
             # these are the users that should no longer be in this account, but should not be removed
             # we need to look up their new VO
             # Again, basic set arithmetic. LHS is the intersection of the people we have left and the active users
             changed_users_vo = (slurm_acct_users - members) & active_accounts
-            changed_users |= changed_users_vo
 
             try:
-                moved_users |= set([(user, vo_id, reverse_vo_mapping[user]) for user in changed_users_vo])
+                moved_users |= {(user, vo_id, reverse_vo_mapping[user]) for user in changed_users_vo}
             except KeyError as err:
                 logging.warning("Found user not belonging to any VO in the reverse VO map: %s", err)
                 if dry_run:
-                    for user in changed_users:
+                    for user in changed_users_vo:
                         try:
-                            moved_users.add((user, reverse_vo_mapping[user]))
+                            moved_users.add((user, vo_id, reverse_vo_mapping[user]))
                         except KeyError as err:
                             logging.warning("Dry run, cannot find up user %s in reverse VO map: %s",
                                             user, err)
@@ -25,6 +25,8 @@ This file contains the utilities for dealing with users on the VSC.
 import logging
 import os
 
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from urllib.request import HTTPError
 
 from vsc.accountpage.wrappers import mkVscAccountPubkey, mkVscHomeOnScratch
@@ -44,6 +46,17 @@ _users_cache = {
     'VscTier2AccountpageUser': {},
 }
 
+# Number of users for which the account page information is fetched at the same time
+PREFETCH_WORKERS = 8
+# Number of users that are created and prefetched before they are processed, this bounds the memory use
+PREFETCH_CHUNK_SIZE = 4 * PREFETCH_WORKERS
+
+
+def clear_users_cache():
+    """Empty the cache of user instances, e.g., between two syncs in the same process."""
+    for cache in _users_cache.values():
+        cache.clear()
+
 
 class UserStatusUpdateError(Exception):
     pass
@@ -75,6 +88,7 @@ class VscAccountPageUser(object):
 
     def _init_cache(self, **kwargs):
         self._cache['pubkeys'] = kwargs.get('pubkeys', None)
+        self._cache['ascii_pubkeys'] = None
         self._cache['account'] = kwargs.get('account', None)
         self._cache['usergroup'] = None
         self._cache['home_on_scratch'] = None
@@ -114,6 +128,13 @@ class VscAccountPageUser(object):
             self._cache['pubkeys'] = [mkVscAccountPubkey(p) for p in ps if not p['deleted']]
         return self._cache['pubkeys']
 
+    @property
+    def ascii_pubkeys(self):
+        """The public keys of the user, as ASCII strings"""
+        if self._cache['ascii_pubkeys'] is None:
+            self._cache['ascii_pubkeys'] = [ensure_ascii_string(p.pubkey) for p in self.pubkeys]
+        return self._cache['ascii_pubkeys']
+
     def get_institute_prefix(self):
         """
         Get the first letter of the institute the user belongs to.
@@ -149,6 +170,8 @@ class VscTier2AccountpageUser(VscAccountPageUser, VscTier2Accountpage):
         self.pickle_storage = pickle_storage
 
         self.institute_path_templates = self.storage.path_templates[self.host_institute]
+        # (path, fileset) of the user on each storage, as given by the path templates
+        self._user_paths = {}
 
         self.vsc = VSC()
 
@@ -191,33 +214,64 @@ class VscTier2AccountpageUser(VscAccountPageUser, VscTier2Accountpage):
         # we no longer set defaults, since we do not want to accidentally revert people to some default
         # that is lower than their actual quota if the accountpage goes down in between retrieving the users
         # and fetching the quota
-        institute_quota = [q for q in all_quota if q.storage['institute'] == self.host_institute]
         fileset_name = self.vsc.user_grouping_fileset(self.account.vsc_id)
-
-        def user_proposition(quota, storage_type):
-            return quota.fileset == fileset_name and quota.storage['storage_type'] == storage_type
+        vo_prefix = VO_PREFIX_BY_INSTITUTE[self.host_institute]
+
+        # sort the quota of the host institute in a single pass
+        home = []
+        data = []
+        scratch = []
+        vo_data = []
+        vo_scratch = []
+        for q in all_quota:
+            storage = q.storage
+            if storage['institute'] != self.host_institute:
+                continue
+            storage_type = storage['storage_type']
+
+            if q.fileset == fileset_name:
+                if storage_type == HOME_KEY:
+                    home.append(q.hard)
+                elif storage_type == DATA_KEY and not storage['name'].endswith(STORAGE_SHARED_SUFFIX):
+                    data.append(q.hard)
+                elif storage_type == SCRATCH_KEY:
+                    scratch.append(q)
+
+            if q.fileset.startswith(vo_prefix):
+                if storage_type == DATA_KEY:
+                    vo_data.append(q)
+                elif storage_type == SCRATCH_KEY:
+                    vo_scratch.append(q)
+
+        quota = {
+            'vo': {
+                'data': vo_data,
+                'scratch': vo_scratch,
+            },
+        }
 
         # Non-UGent users who have quota in Gent, e.g., in a VO, should not have these set
         if self.person.institute['name'] == self.host_institute:
             # next(iter(a_list), None) will return the first item of a_list if the list is non-empty, other None
-            self._cache['quota']['home'] = next(iter([q.hard for q in institute_quota
-                                                      if user_proposition(q, HOME_KEY)]), None)
-            self._cache['quota']['data'] = next(iter([q.hard for q in institute_quota
-                                            if user_proposition(q, DATA_KEY) and not
-                                            q.storage['name'].endswith(STORAGE_SHARED_SUFFIX)]), None)
-            self._cache['quota']['scratch'] = [q for q in institute_quota if user_proposition(q, SCRATCH_KEY)]
+            quota['home'] = next(iter(home), None)
+            quota['data'] = next(iter(data), None)
+            quota['scratch'] = scratch
         else:
-            self._cache['quota']['home'] = None
-            self._cache['quota']['data'] = None
-            self._cache['quota']['scratch'] = None
+            quota['home'] = None
+            quota['data'] = None
+            quota['scratch'] = None
 
-        def user_vo_proposition(quota, storage_type):
-            return quota.fileset.startswith(VO_PREFIX_BY_INSTITUTE[self.host_institute]) and \
-                quota.storage['storage_type'] == storage_type
+        # only fill in the cache once all quota are known, the quota properties take a non-empty cache as complete
+        self._cache['quota'] = quota
 
-        self._cache['quota']['vo'] = {}
-        self._cache['quota']['vo']['data'] = [q for q in institute_quota if user_vo_proposition(q, DATA_KEY)]
-        self._cache['quota']['vo']['scratch'] = [q for q in institute_quota if user_vo_proposition(q, SCRATCH_KEY)]
+    def _get_user_path(self, storage_name):
+        """Get the (path, fileset) of the user on the given storage_name, relative to its mount point."""
+        try:
+            return self._user_paths[storage_name]
+        except KeyError:
+            user_path = self.institute_path_templates[storage_name]['user'](self.account.vsc_id)
+            self._user_paths[storage_name] = user_path
+            return user_path
 
     def pickle_path(self):
         """Provide the location where to store pickle files for this user.
@@ -225,7 +279,7 @@ class VscTier2AccountpageUser(VscAccountPageUser, VscTier2Accountpage):
         This location is the user'path on the pickle_storage specified when creating
         a VscTier2AccountpageUser instance.
         """
-        (path, _) = self.institute_path_templates[self.pickle_storage]['user'](self.account.vsc_id)
+        (path, _) = self._get_user_path(self.pickle_storage)
         return os.path.join(self.institute_storage[self.pickle_storage].backend_mount_point, path)
 
     def _create_grouping_fileset(self, storage, path, fileset_name):
@@ -237,12 +291,12 @@ class VscTier2AccountpageUser(VscAccountPageUser, VscTier2Accountpage):
 
     def _get_path(self, storage_name, mount_point=MOUNT_POINT_DEFAULT):
         """Get the path for the (if any) user directory on the given storage_name."""
-        (path, _) = self.institute_path_templates[storage_name]['user'](self.account.vsc_id)
+        (path, _) = self._get_user_path(storage_name)
         return os.path.join(self._get_mount_path(storage_name, mount_point), path)
 
     def _get_grouping_path(self, storage_name, mount_point=MOUNT_POINT_DEFAULT):
         """Get the path and the fileset for the user group directory (and associated fileset)."""
-        (path, fileset) = self.institute_path_templates[storage_name]['user'](self.account.vsc_id)
+        (path, fileset) = self._get_user_path(storage_name)
         return (os.path.join(self._get_mount_path(storage_name, mount_point), os.path.dirname(path)), fileset)
 
     def _create_user_dir(self, grouping_f, path_f, storage_name):
@@ -349,7 +403,7 @@ class VscTier2AccountpageUser(VscAccountPageUser, VscTier2Accountpage):
             int(self.account.vsc_id_number),
             int(self.usergroup.vsc_id_number),
             path,
-            [ensure_ascii_string(p.pubkey) for p in self.pubkeys],
+            self.ascii_pubkeys,
         )
 
     def __setattr__(self, name, value):
@@ -404,42 +458,93 @@ def update_user_status(user, client):
                                         (user.user_id, account.status))
 
 
+def _prefetch_user_info(user, attributes):
+    """Fetch the given attributes of the user, so they are cached when the user is processed.
+
+    Errors are logged, not raised here. They show up again when the attribute is used during processing.
+    """
+    for attribute in attributes:
+        try:
+            getattr(user, attribute)
+        except Exception as err:
+            logging.warning("Could not prefetch %s for user %s: %s", attribute, user.user_id, err)
+
+
+def prefetch_users_info(users, attributes):
+    """Fetch the account page information of the users concurrently.
+
+    The requests to the account page only wait on the network, so these are done for several users at once.
+    The storage operations on the users are not, as e.g. users sharing a grouping fileset could race to create it.
+
+    @param users: list of VscAccountPageUser instances, a user may occur more than once
+    @param attributes: names of the cached attributes to fetch for each user
+    """
+    unique_users = list(dict([(user.user_id, user) for user in users]).values())
+    if not unique_users:
+        return
+
+    with ThreadPoolExecutor(max_workers=min(PREFETCH_WORKERS, len(unique_users))) as executor:
+        list(executor.map(lambda user: _prefetch_user_info(user, attributes), unique_users))
+
+
+def _chunks(items, size):
+    """Yield lists of at most size consecutive items"""
+    items = iter(items)
+    chunk = list(islice(items, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(items, size))
+
+
 def process_users_quota(options, user_quota, storage_name, client, host_institute=GENT, use_user_cache=True):
     """
     Process the users' quota for the given storage.
+
+    The users are created and their information is prefetched per chunk of PREFETCH_CHUNK_SIZE quota.
     """
     error_quota = []
     ok_quota = []
 
-    for quota in user_quota:
-        user = VscTier2AccountpageUser(quota.user,
-                                       rest_client=client,
-                                       host_institute=host_institute,
-                                       use_user_cache=use_user_cache)
-        user.dry_run = options.dry_run
+    for chunk in _chunks(user_quota, PREFETCH_CHUNK_SIZE):
+        quota_users = [
+            (quota, VscTier2AccountpageUser(quota.user,
+                                            rest_client=client,
+                                            host_institute=host_institute,
+                                            use_user_cache=use_user_cache))
+            for quota in chunk
+        ]
+        # any of the quota properties fetches all quota of the user
+        prefetch_users_info([user for (_, user) in quota_users], ('account', 'user_home_quota'))
 
-        try:
-            if storage_name == VSC_HOME:
-                user.set_home_quota()
+        for (quota, user) in quota_users:
+            user.dry_run = options.dry_run
 
-            if storage_name == VSC_DATA:
-                user.set_data_quota()
+            try:
+                if storage_name == VSC_HOME:
+                    user.set_home_quota()
 
-            if storage_name in VSC_PRODUCTION_SCRATCH[host_institute]:
-                user.set_scratch_quota(storage_name)
+                if storage_name == VSC_DATA:
+                    user.set_data_quota()
 
-            ok_quota.append(quota)
-        except Exception:
-            logging.exception("Cannot process user %s", user.user_id)
-            error_quota.append(quota)
+                if storage_name in VSC_PRODUCTION_SCRATCH[host_institute]:
+                    user.set_scratch_quota(storage_name)
+
+                ok_quota.append(quota)
+            except Exception:
+                logging.exception("Cannot process user %s", user.user_id)
+                error_quota.append(quota)
 
     return (ok_quota, error_quota)
 
 
-def process_users(options, account_ids, storage_name, client, host_institute=GENT, use_user_cache=True):
+def process_users(options, account_ids, storage_name, client, host_institute=GENT, use_user_cache=True,
+                  accounts=None):
     """
     Process the users.
 
+    @param accounts: dict mapping (some of) the account_ids on their VscAccount namedtuple, to avoid calling
+                     the REST api for each of these accounts.
+
     We make a distinction here between three types of filesystems.
         - home (unique)
             - create and populate the home directory
@@ -450,32 +555,48 @@ def process_users(options, account_ids, storage_name, client, host_institute=GEN
             - create the grouping fileset if needed
             - create the user scratch directory
 
+    The users are created and their information is prefetched per chunk of PREFETCH_CHUNK_SIZE users.
     """
     error_users = []
     ok_users = []
 
-    for vsc_id in sorted(account_ids):
-        user = VscTier2AccountpageUser(vsc_id,
-                                       rest_client=client,
-                                       host_institute=host_institute,
-                                       use_user_cache=use_user_cache)
-        user.dry_run = options.dry_run
-
-        try:
-            if storage_name == VSC_HOME:
-                user.create_home_dir()
-                user.populate_home_dir()
-                update_user_status(user, client)
-
-            if storage_name == VSC_DATA:
-                user.create_data_dir()
-
-            if storage_name in VSC_PRODUCTION_SCRATCH[host_institute]:
-                user.create_scratch_dir(storage_name)
+    if accounts is None:
+        accounts = {}
 
-            ok_users.append(user)
-        except Exception:
-            logging.exception("Cannot process user %s", user.user_id)
-            error_users.append(user)
+    if storage_name == VSC_HOME:
+        attributes = ('account', 'usergroup', 'pubkeys')
+    else:
+        attributes = ('account', 'usergroup')
+
+    for chunk in _chunks(account_ids, PREFETCH_CHUNK_SIZE):
+        users = [
+            VscTier2AccountpageUser(vsc_id,
+                                    rest_client=client,
+                                    account=accounts.get(vsc_id),
+                                    host_institute=host_institute,
+                                    use_user_cache=use_user_cache)
+            for vsc_id in chunk
+        ]
+        prefetch_users_info(users, attributes)
+
+        for user in users:
+            user.dry_run = options.dry_run
+
+            try:
+                if storage_name == VSC_HOME:
+                    user.create_home_dir()
+                    user.populate_home_dir()
+                    update_user_status(user, client)
+
+                if storage_name == VSC_DATA:
+                    user.create_data_dir()
+
+                if storage_name in VSC_PRODUCTION_SCRATCH[host_institute]:
+                    user.create_scratch_dir(storage_name)
+
+                ok_users.append(user)
+            except Exception:
+                logging.exception("Cannot process user %s", user.user_id)
+                error_users.append(user)
 
     return (ok_users, error_users)
@@ -18,11 +18,14 @@ Tests for vsc.administration.slurm.*
 @author: Andy Georges (Ghent University)
 """
 
+import shlex
+
+from mock import patch
 from vsc.install.testing import TestCase
 
 from vsc.administration.slurm.sacctmgr import (
-    parse_slurm_sacct_dump,
-    SacctMgrTypes, SlurmAccount, SlurmUser,
+    merge_add_user_commands, parse_slurm_sacct_dump, render_sacctmgr_script,
+    SacctMgrException, SacctMgrTypes, SlurmAccount, SlurmUser,
     )
 
 
@@ -58,6 +61,7 @@ class SlurmSacctmgrTest(TestCase):
             "account1|vo1|None|banette|vo1||1|||||||normal|",
             "account2|vo1|None|banette|vo1||1|||||||normal|",
             "account3|vo2|None|banette|vo2||1|||||||normal|",
+            "account4|vo2|None|banette|vo2||1",
         ]
 
         info = parse_slurm_sacct_dump(sacctmgr_user_output, SacctMgrTypes.users)
@@ -68,4 +72,72 @@ class SlurmSacctmgrTest(TestCase):
             SlurmUser(User='account3', Def_Acct='vo2', Admin='None', Cluster='banette', Account='vo2', Partition='', Share='1', MaxJobs='', MaxNodes='', MaxCPUs='', MaxSubmit='', MaxWall='', MaxCPUMins='', QOS='normal', Def_QOS=''),
         ]))
 
+    def test_parse_slurm_sacct_dump_missing_column(self):
+        """Test that a failure on a line with a missing column is logged with the original line."""
+
+        sacctmgr_resource_output = [
+            "Name|Server|Type|% Allocated|ServerType",
+            "comsol|bogus|License|0|flexlm",
+        ]
+
+        with patch('vsc.administration.slurm.sacctmgr.logging') as mlogging:
+            with self.assertRaises(TypeError):
+                parse_slurm_sacct_dump(sacctmgr_resource_output, SacctMgrTypes.resource)
+
+        self.assertEqual(mlogging.exception.call_args[0][1], "comsol|bogus|License|0|flexlm")
+
+    def test_merge_add_user_commands(self):
+        """Test that consecutive add user commands with the same arguments are merged."""
+
+        commands = [shlex.split(c) for c in [
+            "/usr/bin/sacctmgr -i add user vsc1 Account=gvo1 Cluster=mycluster",
+            "/usr/bin/sacctmgr -i add user vsc2 Account=gvo2 Cluster=mycluster",
+            "/usr/bin/sacctmgr -i add user vsc3 Account=gvo1 Cluster=mycluster",
+            "/usr/bin/sacctmgr -i add user vsc4 Account=gvo1 Cluster=mycluster DefaultAccount=gvo1",
+            "/usr/bin/sacctmgr -i remove user Name=vsc5 Account=gvo1 Cluster=mycluster",
+            "/usr/bin/sacctmgr -i add user vsc6 Account=gvo1 Cluster=mycluster",
+        ]]
+
+        self.assertEqual(merge_add_user_commands(commands), [shlex.split(c) for c in [
+            "/usr/bin/sacctmgr -i add user vsc1,vsc3 Account=gvo1 Cluster=mycluster",
+            "/usr/bin/sacctmgr -i add user vsc2 Account=gvo2 Cluster=mycluster",
+            "/usr/bin/sacctmgr -i add user vsc4 Account=gvo1 Cluster=mycluster DefaultAccount=gvo1",
+            "/usr/bin/sacctmgr -i remove user Name=vsc5 Account=gvo1 Cluster=mycluster",
+            "/usr/bin/sacctmgr -i add user vsc6 Account=gvo1 Cluster=mycluster",
+        ]])
+
+        # the number of user names in a merged command is limited
+        self.assertEqual(merge_add_user_commands(commands[:4], max_names=1), commands[:4])
+        self.assertEqual(merge_add_user_commands(
+            [shlex.split(f"/usr/bin/sacctmgr -i add user vsc{i} Account=gvo1 Cluster=mycluster") for i in range(5)],
+            max_names=2,
+        ), [shlex.split(c) for c in [
+            "/usr/bin/sacctmgr -i add user vsc0,vsc1 Account=gvo1 Cluster=mycluster",
+            "/usr/bin/sacctmgr -i add user vsc2,vsc3 Account=gvo1 Cluster=mycluster",
+            "/usr/bin/sacctmgr -i add user vsc4 Account=gvo1 Cluster=mycluster",
+        ]])
+
+    def test_render_sacctmgr_script(self):
+        """Test that sacctmgr commands are rendered as lines of a sacctmgr script."""
+
+        commands = [shlex.split(c) for c in [
+            "/usr/bin/sacctmgr -i add user vsc1 Account=gvo1 Cluster=mycluster",
+            "/usr/bin/sacctmgr -i modify qos Name=mycluster-proj1 set 'GRPTRESMins=billing=60,cpu=60'",
+            "/usr/bin/sacctmgr -i add account 'my account' Parent=gent Organization=ugent Cluster=mycluster",
+        ]]
+
+        self.assertEqual(render_sacctmgr_script(commands), "\n".join([
+            "add user vsc1 Account=gvo1 Cluster=mycluster",
+            "modify qos Name=mycluster-proj1 set GRPTRESMins=billing=60,cpu=60",
+            'add account "my account" Parent=gent Organization=ugent Cluster=mycluster',
+        ]) + "\n")
+        self.assertEqual(render_sacctmgr_script([]), "")
+
+        # only double quotes are known to sacctmgr, for key=value arguments the value is quoted
+        self.assertEqual(render_sacctmgr_script([
+            ["/usr/bin/sacctmgr", "-i", "modify", "account", "Name=vo1", "set", "Description=it's a vo"],
+        ]), 'modify account Name=vo1 set Description="it\'s a vo"\n')
 
+        for arg in ['Description=a "quoted" vo', "Description=two\nlines"]:
+            with self.assertRaises(SacctMgrException):
+                render_sacctmgr_script([["/usr/bin/sacctmgr", "-i", "modify", "account", "Name=vo1", "set", arg]])
@@ -43,7 +43,10 @@ class SlurmScontrolTest(TestCase):
 
         info = parse_scontrol_dump(scontrol_output, ScontrolTypes.reservation)
 
-        self.assertEqual(info, set())
+        self.assertEqual(set(info), set())
+
+        info = parse_scontrol_dump(["", "No licenses configured in Slurm.", ""], ScontrolTypes.license)
+        self.assertEqual(info, [])
 
         # test reservation output
         scontrol_output = [
@@ -53,7 +56,7 @@ class SlurmScontrolTest(TestCase):
 
         info = parse_scontrol_dump(scontrol_output, ScontrolTypes.reservation)
 
-        self.assertEqual(info, set([
+        self.assertEqual(set(info), set([
             SlurmReservation(ReservationName='hpc123', StartTime='2022-03-28T16:05:00', EndTime='2028-05-28T07:59:59', Duration='2252-15:54:59', Nodes='node123,node456', NodeCnt='2', CoreCnt='512', Features=None, PartitionName=None, Flags='MAINT,IGNORE_JOBS,SPEC_NODES', TRES='cpu=512', Users='vscabc,vscdef', Groups=None, Accounts=None, Licenses=None, State='ACTIVE', BurstBuffer=None, Watts='n/a', MaxStartDelay=None),
             SlurmReservation(ReservationName='hellohello', StartTime='2022-04-19T08:00:00', EndTime='2022-05-19T08:00:00', Duration='30-00:00:00', Nodes='nodeone,nodetwo,nodethree,nodefour', NodeCnt='4', CoreCnt='8', Features=None, PartitionName='party', Flags='', TRES='cpu=8', Users=None, Groups='groupies', Accounts='myaccount', Licenses=None, State='ACTIVE', BurstBuffer=None, Watts='n/a', MaxStartDelay=None),
         ]))
@@ -66,7 +69,7 @@ class SlurmScontrolTest(TestCase):
 
         info = parse_scontrol_dump(scontrol_output, ScontrolTypes.license)
 
-        self.assertEqual(info, set([
+        self.assertEqual(set(info), set([
             SlurmLicense(LicenseName='comsol3@bogus', Total=2, Used=0, Free=2, Reserved=0, Remote='yes'),
             SlurmLicense(LicenseName='comsol3@bogus2', Total=4, Used=1, Free=3, Reserved=0, Remote='yes'),
         ]))
@@ -74,7 +77,7 @@ class SlurmScontrolTest(TestCase):
         # test config output (this is re-formatted oneliner output)
         scontrol_output = ['ClusterName="mycluster" AccountingStorageHost="mydb" NotRelevant="abc def" SLURM_CONF="/etc/slurm/slurm.conf" SLURM_VERSION="20.11.6"']
         info = parse_scontrol_dump(scontrol_output, ScontrolTypes.config)
-        self.assertEqual(info, set([
+        self.assertEqual(set(info), set([
             SlurmConfig(ClusterName='mycluster', AccountingStorageHost='mydb', SLURM_CONF='/etc/slurm/slurm.conf',
                         SLURM_VERSION='20.11.6',
                         )
@@ -85,7 +88,7 @@ class SlurmScontrolTest(TestCase):
             'PartitionName=mypart AllowGroups=gabc,wheel AllowAccounts=ALL AllowQos=ALL AllocNodes=ALL Default=YES QoS=N/A DefaultTime=01:00:00 DisableRootJobs=YES ExclusiveUser=NO GraceTime=0 Hidden=NO MaxNodes=UNLIMITED MaxTime=3-00:00:00 MinNodes=0 LLN=NO MaxCPUsPerNode=UNLIMITED Nodes=node1,node2 PriorityJobFactor=1 PriorityTier=1 RootOnly=NO ReqResv=NO OverSubscribe=NO OverTimeLimit=NONE PreemptMode=OFF State=UP TotalCPUs=32 TotalNodes=2 SelectTypeParameters=NONE JobDefaults=(null) DefMemPerCPU=800 MaxMemPerNode=3200 TRESBillingWeights=CPU=1,Mem=1.33G',
         ]
         info = parse_scontrol_dump(scontrol_output, ScontrolTypes.partition)
-        self.assertEqual(info, set([
+        self.assertEqual(set(info), set([
             SlurmPartition(PartitionName='mypart', AllowGroups='gabc,wheel', AllowAccounts='ALL', AllowQos='ALL', AllocNodes='ALL', Default='YES', QoS='N/A', DefaultTime='01:00:00', DisableRootJobs='YES', ExclusiveUser='NO', GraceTime='0', Hidden='NO', MaxNodes='UNLIMITED', MaxTime='3-00:00:00', MinNodes='0', LLN='NO', MaxCPUsPerNode='UNLIMITED', Nodes='node1,node2', PriorityJobFactor='1', PriorityTier='1', RootOnly='NO', ReqResv='NO', OverSubscribe='NO', OverTimeLimit='NONE', PreemptMode='OFF', State='UP', TotalCPUs=32, TotalNodes=2, SelectTypeParameters='NONE', JobDefaults=None, DefMemPerCPU=800, MaxMemPerNode=3200, TRESBillingWeights='CPU=1,Mem=1.33G'),
         ]))
 
@@ -129,11 +132,11 @@ CgroupMountpoint        = (null)
         self.assertEqual(args, (['/usr/bin/scontrol', 'show', 'config', '--detail', '--oneliner'],))
         self.assertEqual(kwargs, {})
 
-        self.assertEqual(info, set([
+        self.assertEqual(set(info), set([
             SlurmConfig(ClusterName='mycluster', AccountingStorageHost='mydb', SLURM_CONF='/etc/slurm/slurm.conf',
                         SLURM_VERSION='20.11.6',
                         )
         ]))
 
         config = get_scontrol_config()
-        self.assertEqual(info, set([config]))
+        self.assertEqual(set(info), set([config]))
@@ -21,11 +21,13 @@ import shlex
 
 from collections import namedtuple
 
+from mock import patch
 from vsc.install.testing import TestCase
 
-from vsc.administration.slurm.sacctmgr import SacctMgrTypes, SlurmUser
+from vsc.administration.slurm.sacctmgr import SACCT_MAX_NAMES, SacctMgrTypes, SlurmQos, SlurmUser
 
 from vsc.administration.slurm.sync import (
+    SCommandException, execute_commands, execute_sacctmgr_commands, get_qos_by_cluster,
     slurm_vo_accounts, slurm_user_accounts,
     slurm_institute_accounts, slurm_project_accounts, slurm_project_users_accounts,
     slurm_project_qos,
@@ -42,6 +44,108 @@ Project.__new__.__defaults__ = (None,) * len(Project._fields)
 class SlurmSyncTestGent(TestCase):
     """Test for the slurm account sync in Gent"""
 
+    @patch('vsc.administration.slurm.sync.RunNoShell')
+    def test_execute_commands(self, mnoshell):
+        """Test that consecutive sacctmgr commands are run in a single process."""
+        mnoshell.run.return_value = (0, "")
+
+        execute_commands([
+            shlex.split("/usr/bin/sacctmgr -i add account gvo00001 Parent=gent Organization=ugent Cluster=mycluster"),
+            shlex.split("/usr/bin/sacctmgr -i add user vsc40001 Account=gvo00001 Cluster=mycluster"),
+            shlex.split("/usr/bin/scancel --cluster=mycluster --user=vsc40002 --account=gvo00002"),
+            shlex.split("/usr/bin/sacctmgr -i remove user Name=vsc40002 Account=gvo00002 Cluster=mycluster"),
+        ])
+
+        self.assertEqual(mnoshell.run.mock_calls[0][1:], (
+            (["/usr/bin/sacctmgr", "-i"],),
+            {'input': "add account gvo00001 Parent=gent Organization=ugent Cluster=mycluster\n"
+                      "add user vsc40001 Account=gvo00001 Cluster=mycluster\n"},
+        ))
+        self.assertEqual(mnoshell.run.mock_calls[1][1:], (
+            (shlex.split("/usr/bin/scancel --cluster=mycluster --user=vsc40002 --account=gvo00002"),),
+            {},
+        ))
+        self.assertEqual(mnoshell.run.mock_calls[2][1:], (
+            (["/usr/bin/sacctmgr", "-i"],),
+            {'input': "remove user Name=vsc40002 Account=gvo00002 Cluster=mycluster\n"},
+        ))
+        self.assertEqual(len(mnoshell.run.mock_calls), 3)
+
+        # a failing batch is retried command by command, the failing command raises
+        mnoshell.reset_mock()
+        mnoshell.run.side_effect = [(1, "error"), (0, ""), (1, "error")]
+
+        with self.assertRaises(SCommandException):
+            execute_commands([
+                shlex.split("/usr/bin/sacctmgr -i add user vsc40001 Account=gvo00001 Cluster=mycluster"),
+                shlex.split("/usr/bin/sacctmgr -i add user vsc40002 Account=gvo00002 Cluster=mycluster"),
+            ])
+
+        self.assertEqual([c[1] for c in mnoshell.run.mock_calls], [
+            (["/usr/bin/sacctmgr", "-i"],),
+            (shlex.split("/usr/bin/sacctmgr -i add user vsc40001 Account=gvo00001 Cluster=mycluster"),),
+            (shlex.split("/usr/bin/sacctmgr -i add user vsc40002 Account=gvo00002 Cluster=mycluster"),),
+        ])
+
+        # a batch failing partway through: the commands applied by the batch are not an error when run again,
+        # the command that really fails is reported and the remaining commands are not run
+        mnoshell.reset_mock()
+        mnoshell.run.side_effect = [
+            (1, " Nothing new added.\n Problem adding user associations\n"),
+            (1, " Nothing new added.\n"),
+            (1, " Problem adding user associations\n"),
+        ]
+
+        with self.assertRaises(SCommandException) as cm:
+            execute_commands([
+                shlex.split("/usr/bin/sacctmgr -i add user vsc40001 Account=gvo00001 Cluster=mycluster"),
+                shlex.split("/usr/bin/sacctmgr -i add user vsc40002 Account=gvo00002 Cluster=mycluster"),
+                shlex.split("/usr/bin/sacctmgr -i remove user Name=vsc40003 Account=gvo00003 Cluster=mycluster"),
+            ])
+
+        self.assertTrue("vsc40002" in str(cm.exception))
+        self.assertEqual([c[1] for c in mnoshell.run.mock_calls], [
+            (["/usr/bin/sacctmgr", "-i"],),
+            (shlex.split("/usr/bin/sacctmgr -i add user vsc40001 Account=gvo00001 Cluster=mycluster"),),
+            (shlex.split("/usr/bin/sacctmgr -i add user vsc40002 Account=gvo00002 Cluster=mycluster"),),
+        ])
+
+        # all commands of a failed batch were already applied or succeed when run again
+        mnoshell.reset_mock()
+        mnoshell.run.side_effect = [(1, " Nothing deleted\n"), (1, " Nothing deleted\n"), (0, "")]
+
+        execute_commands([
+            shlex.split("/usr/bin/sacctmgr -i remove user Name=vsc40001 Account=gvo00001 Cluster=mycluster"),
+            shlex.split("/usr/bin/sacctmgr -i remove user Name=vsc40002 Account=gvo00002 Cluster=mycluster"),
+        ])
+        self.assertEqual(len(mnoshell.run.mock_calls), 3)
+
+        # large runs of sacctmgr commands are split in batches
+        mnoshell.reset_mock()
+        mnoshell.run.side_effect = None
+        mnoshell.run.return_value = (0, "")
+
+        execute_sacctmgr_commands([
+            shlex.split(f"/usr/bin/sacctmgr -i add account gvo0000{i} Parent=gent Organization=ugent Cluster=mycluster")
+            for i in range(5)
+        ], batch_size=2)
+
+        self.assertEqual([c[2]['input'].count("\n") for c in mnoshell.run.mock_calls], [2, 2, 1])
+
+        # consecutive scancel commands all run, a failure is raised afterwards
+        mnoshell.reset_mock()
+        mnoshell.run.side_effect = lambda command: (1, "error") if "--user=vsc40001" in command else (0, "")
+
+        scancel_commands = [
+            shlex.split("/usr/bin/scancel --cluster=mycluster --user=vsc40001"),
+            shlex.split("/usr/bin/scancel --cluster=mycluster --user=vsc40002"),
+            shlex.split("/usr/bin/scancel --cluster=mycluster --user=vsc40003"),
+        ]
+        with self.assertRaises(SCommandException):
+            execute_commands(scancel_commands)
+
+        self.assertEqual(sorted([c[1][0] for c in mnoshell.run.mock_calls]), scancel_commands)
+
     def test_slurm_vo_accounts(self):
         """Test that the commands to create accounts are correctly generated."""
 
@@ -92,10 +196,8 @@ class SlurmSyncTestGent(TestCase):
         self.assertEqual(set([tuple(x) for x in commands]), set([tuple(x) for x in [
             shlex.split("/usr/bin/sacctmgr -i add account gpr_compute_project3 Parent=projects Organization=ugent Cluster=mycluster Qos=mycluster-gpr_compute_project3,qosforall"),
             shlex.split("/usr/bin/sacctmgr -i add account gpr_compute_project4 Parent=projects Organization=ugent Cluster=mycluster Qos=mycluster-gpr_compute_project4,qosforall"),
-            shlex.split("/usr/bin/scancel --cluster=mycluster --account=gpr_compute_project5 --state=PENDING"),
-            shlex.split("/usr/bin/scancel --cluster=mycluster --account=gpr_compute_project5 --state=SUSPENDED"),
-            shlex.split("/usr/bin/scancel --cluster=mycluster --account=gpr_compute_project7 --state=PENDING"),
-            shlex.split("/usr/bin/scancel --cluster=mycluster --account=gpr_compute_project7 --state=SUSPENDED"),
+            shlex.split("/usr/bin/scancel --cluster=mycluster --account=gpr_compute_project5 --state=PENDING,SUSPENDED"),
+            shlex.split("/usr/bin/scancel --cluster=mycluster --account=gpr_compute_project7 --state=PENDING,SUSPENDED"),
             shlex.split("/usr/bin/sacctmgr -i remove account Name=gpr_compute_project5 Cluster=mycluster"),
             shlex.split("/usr/bin/sacctmgr -i remove account Name=gpr_compute_project7 Cluster=mycluster"),
         ]]))
@@ -129,6 +231,67 @@ class SlurmSyncTestGent(TestCase):
             shlex.split("/usr/bin/sacctmgr -i remove qos where Name=mycluster-gpr_compute_project4"),
         ]]))
 
+        # QOS that already have the requested settings are not modified again
+        slurm_qos_info = [
+            SlurmQos(Name="mycluster-gpr_compute_project1", Flags="DenyOnLimit,NoDecay",
+                     GrpTRESMins="cpu=2280,billing=2280,gres/gpu=180"),
+            SlurmQos(Name="mycluster-gpr_compute_project2", Flags="DenyOnLimit,NoDecay",
+                     GrpTRESMins="cpu=300,billing=300,gres/gpu=1"),
+            SlurmQos(Name="mycluster-gpr_compute_project3", Flags="DenyOnLimit,NoDecay",
+                     GrpTRESMins="cpu=120,billing=120,gres/gpu=1"),
+        ]
+
+        commands = slurm_project_qos(projects, slurm_qos_info, ["mycluster"], ["protected_qos"])
+
+        self.assertEqual([tuple(x) for x in commands], [tuple(x) for x in [
+            shlex.split("/usr/bin/sacctmgr -i modify qos mycluster-gpr_compute_project3 set flags=NoDecay,DenyOnLimit GRPTRESMins=billing=240,cpu=240,gres/gpu=1"),
+        ]])
+
+        # QOS with the same settings are modified with a single command
+        projects.append(PR(name="gpr_compute_project4", cpu_hours=4, gpu_hours=0))
+        slurm_qos_info.append(SlurmQos(Name="mycluster-gpr_compute_project4"))
+
+        commands = slurm_project_qos(projects, slurm_qos_info, ["mycluster"], ["protected_qos"])
+
+        self.assertEqual([tuple(x) for x in commands], [tuple(x) for x in [
+            shlex.split("/usr/bin/sacctmgr -i modify qos mycluster-gpr_compute_project3,mycluster-gpr_compute_project4 set flags=NoDecay,DenyOnLimit GRPTRESMins=billing=240,cpu=240,gres/gpu=1"),
+        ]])
+
+        # QOS with other flags as well are modified, as the command replaces the flags
+        slurm_qos_info[0] = slurm_qos_info[0]._replace(Flags="DenyOnLimit,NoDecay,NoReserve")
+
+        commands = slurm_project_qos(projects, slurm_qos_info, ["mycluster"], ["protected_qos"])
+
+        self.assertEqual([tuple(x) for x in commands], [tuple(x) for x in [
+            shlex.split("/usr/bin/sacctmgr -i modify qos mycluster-gpr_compute_project1 set flags=NoDecay,DenyOnLimit GRPTRESMins=billing=2280,cpu=2280,gres/gpu=180"),
+            shlex.split("/usr/bin/sacctmgr -i modify qos mycluster-gpr_compute_project3,mycluster-gpr_compute_project4 set flags=NoDecay,DenyOnLimit GRPTRESMins=billing=240,cpu=240,gres/gpu=1"),
+        ]])
+
+        # the number of QOS in a single modify command is limited
+        many_projects = [PR(name=f"gpr_compute_many{i}", cpu_hours=1, gpu_hours=0) for i in range(SACCT_MAX_NAMES + 1)]
+
+        commands = slurm_project_qos(many_projects, [], ["mycluster"], [])
+
+        modify_commands = [c for c in commands if c[2] == "modify"]
+        self.assertEqual([len(c[4].split(",")) for c in modify_commands], [SACCT_MAX_NAMES, 1])
+
+
+    def test_get_qos_by_cluster(self):
+        """Test that the QOS are grouped per cluster, also for clusters with a dash in their name."""
+        SQI = namedtuple("SQI", ["Name"])
+
+        slurm_qos_info = [
+            SQI(Name="mycluster-gpr_compute_project1"),
+            SQI(Name="other-cluster-gpr_compute_project2"),
+            SQI(Name="other-gpr_compute_project3"),
+            SQI(Name="normal"),
+        ]
+
+        self.assertEqual(get_qos_by_cluster(slurm_qos_info, ["mycluster", "other-cluster", "empty"]), {
+            "mycluster": ["mycluster-gpr_compute_project1"],
+            "other-cluster": ["other-cluster-gpr_compute_project2"],
+            "empty": [],
+        })
 
     def test_slurm_project_users_accounts(self):
         project_members = [
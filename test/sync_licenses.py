@@ -227,12 +227,14 @@ ReservationName=external_license_comsol3@bogus2 StartTime=2022-04-29T12:01:11 En
 ReservationName=external_license_ano-1@ano-comp1 StartTime=2022-04-29T12:01:11 EndTime=2023-04-29T12:01:11 Duration=365-00:00:00 Nodes=(null) NodeCnt=0 CoreCnt=0 Features=(null) PartitionName=cubone Flags=ANY_NODES TRES=(null) Users=root Groups=(null) Accounts=(null) Licenses=ano-1@ano-comp1:4 State=ACTIVE BurstBuffer=(null) Watts=n/a MaxStartDelay=(null)
 """
 
-        masync.side_effect = [
-            (0, scontrol_config),
-            (0, scontrol_part),
-            (0, scontrol_lic),
-            (0, scontrol_res),
-            ]
+        # the partition, license and reservation info is retrieved concurrently
+        scontrol_outputs = {
+            'config': scontrol_config,
+            'partition': scontrol_part,
+            'license': scontrol_lic,
+            'reservation': scontrol_res,
+        }
+        masync.side_effect = lambda cmd: (0, scontrol_outputs[cmd[2]])
 
         nw_up, rem = update_license_reservations(licenses, 'mycluster', 'mypart', [], False)
         logging.debug("run calls: %s", masync.mock_calls)
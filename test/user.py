@@ -541,6 +541,80 @@ class UserDeploymentTest(TestCase):
 
                             self.assertEqual(mock_user_instance.create_scratch_dir.called, True)
 
+    @mock.patch('vsc.accountpage.client.AccountpageClient', autospec=True)
+    def test_process_users_with_accounts(self, mock_client):
+        """Test that the given account records are passed to the users, others fetch their account."""
+        Options = namedtuple("Options", ['dry_run'])
+        options = Options(dry_run=False)
+
+        test_account = mkVscAccount(test_account_1)
+
+        with mock.patch('vsc.administration.user.VscTier2AccountpageUser', autospec=True) as mock_user:
+            mock_user.return_value = mock.MagicMock()
+
+            user.process_users(options, ['vsc40075', 'vsc40123'], VSC_DATA, mock_client, host_institute=GENT,
+                               accounts={'vsc40075': test_account})
+
+            accounts = dict([(c[1][0], c[2]['account']) for c in mock_user.call_args_list])
+            self.assertEqual(accounts, {'vsc40075': test_account, 'vsc40123': None})
+
+    def test_prefetch_users_info(self):
+        """Test that the attributes are fetched once per user and that failures are logged."""
+        fetched = []
+
+        class PrefetchUser(object):
+            def __init__(self, user_id):
+                self.user_id = user_id
+
+            @property
+            def account(self):
+                fetched.append((self.user_id, 'account'))
+                return self.user_id
+
+            @property
+            def usergroup(self):
+                fetched.append((self.user_id, 'usergroup'))
+                if self.user_id == 'vsc40002':
+                    raise ValueError("account page is down")
+                return self.user_id
+
+            @property
+            def pubkeys(self):
+                fetched.append((self.user_id, 'pubkeys'))
+                return []
+
+        users = [PrefetchUser('vsc40001'), PrefetchUser('vsc40002'), PrefetchUser('vsc40001')]
+
+        with mock.patch('vsc.administration.user.logging') as mock_logging:
+            user.prefetch_users_info(users, ('account', 'usergroup', 'pubkeys'))
+
+        # a failing attribute does not keep the other attributes from being fetched
+        self.assertEqual(sorted(fetched), [
+            (user_id, attribute)
+            for user_id in ('vsc40001', 'vsc40002')
+            for attribute in ('account', 'pubkeys', 'usergroup')
+        ])
+        self.assertEqual(mock_logging.warning.call_count, 1)
+
+        user.prefetch_users_info([], ('account',))
+
+    @mock.patch('vsc.accountpage.client.AccountpageClient', autospec=True)
+    def test_process_users_in_chunks(self, mock_client):
+        """Test that the users are prefetched in chunks."""
+        Options = namedtuple("Options", ['dry_run'])
+        options = Options(dry_run=False)
+
+        with mock.patch('vsc.administration.user.VscTier2AccountpageUser', autospec=True) as mock_user:
+            with mock.patch('vsc.administration.user.prefetch_users_info') as mock_prefetch:
+                with mock.patch('vsc.administration.user.PREFETCH_CHUNK_SIZE', 2):
+                    mock_user.return_value = mock.MagicMock()
+
+                    (ok, failed) = user.process_users(options, ['vsc40075', 'vsc40123', 'vsc40039'], VSC_DATA,
+                                                      mock_client, host_institute=GENT)
+
+                    self.assertEqual([len(c[1][0]) for c in mock_prefetch.call_args_list], [2, 1])
+                    self.assertEqual((len(ok), len(failed)), (3, 0))
+
     @mock.patch('vsc.accountpage.client.AccountpageClient', autospec=True)
     def test_create_home_dir_tier2_user(self, mock_client):
 